@@ -0,0 +1,268 @@
+"""
+Benchmarks do backend EcoGuard.
+
+Executa cenários contra um servidor em execução (BENCH_BACKEND_URL) e mede
+latência por requisição. Cenários que precisam de massa de dados gravam
+diretamente no mesmo banco do servidor (MONGO_URL / DB_NAME do .env) e
+removem tudo o que criaram ao final. Cenários:
+    login     - tempestade de logins concorrentes via /api/auth/session
+                (requer OAUTH_BASE_URL apontando para oauth_standin.py)
+    inspecao  - POST /api/inspecoes em plantas com 10/100/1000 áreas
+    itens     - GET /api/inspecoes/{id}/items com 100/1000 itens, com o
+                número de consultas ao Mongo por requisição (opcounters)
+
+Uso:
+    python benchmark.py login [--requests 500] [--concurrency 50]
+    python benchmark.py inspecao [--sizes 10,100,1000] [--requests 5]
+    python benchmark.py itens [--sizes 100,1000] [--requests 20]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+import httpx
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+BACKEND_URL = os.environ.get('BENCH_BACKEND_URL', 'http://localhost:8001/api')
+# Mesmo endereço padrão do oauth_standin.py
+BENCH_EMAIL = os.environ.get('OAUTH_STANDIN_EMAIL', 'bench@ecoguard.invalid')
+
+def conectar_db():
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    return client[os.environ['DB_NAME']]
+
+def resumo(nome: str, latencias: list, erros: int, duracao: float):
+    latencias = sorted(latencias)
+    p95 = latencias[max(int(len(latencias) * 0.95) - 1, 0)] if latencias else 0
+    print(f"{nome}: {len(latencias)} ok, {erros} erros em {duracao:.2f}s "
+          f"({len(latencias) / duracao:.1f} req/s)")
+    if latencias:
+        print(f"   p50={statistics.median(latencias) * 1000:.1f}ms "
+              f"p95={p95 * 1000:.1f}ms max={latencias[-1] * 1000:.1f}ms")
+
+async def contar_consultas(db) -> int:
+    """Total de queries e getMores executados pelo servidor Mongo até agora"""
+    status = await db.command("serverStatus")
+    return status["opcounters"]["query"] + status["opcounters"]["getmore"]
+
+async def criar_sessao_bench(db) -> tuple:
+    """Cria (ou reaproveita) o usuário de benchmark e uma sessão válida"""
+    user = await db.users.find_one({"email": BENCH_EMAIL}, {"_id": 0})
+    if user:
+        user_id = user["user_id"]
+    else:
+        user_id = f"user_{uuid.uuid4().hex[:12]}"
+        await db.users.insert_one({
+            "user_id": user_id,
+            "email": BENCH_EMAIL,
+            "name": "Benchmark",
+            "picture": None,
+            "created_at": datetime.now(timezone.utc)
+        })
+    session_token = f"bench_{uuid.uuid4().hex}"
+    await db.user_sessions.insert_one({
+        "user_id": user_id,
+        "session_token": session_token,
+        "expires_at": datetime.now(timezone.utc) + timedelta(hours=1),
+        "created_at": datetime.now(timezone.utc)
+    })
+    return user_id, session_token
+
+async def criar_planta_bench(db, user_id: str, total_areas: int) -> tuple:
+    """Cria empresa e planta com total_areas áreas, alternando os tipos do checklist"""
+    tipos = await db.checklist_items.distinct("tipo_area") or ["residuos"]
+    empresa_id = f"emp_{uuid.uuid4().hex[:12]}"
+    planta_id = f"plt_{uuid.uuid4().hex[:12]}"
+    agora = datetime.now(timezone.utc)
+    await db.empresas.insert_one({
+        "empresa_id": empresa_id,
+        "cliente_id": "default_client",
+        "user_id": user_id,
+        "nome": "Empresa Benchmark",
+        "cnpj": "00.000.000/0000-00",
+        "setor": "Geral",
+        "created_at": agora,
+        "updated_at": agora
+    })
+    await db.plantas_estabelecimento.insert_one({
+        "planta_id": planta_id,
+        "empresa_id": empresa_id,
+        "nome": f"Planta Benchmark {total_areas}",
+        "arquivo_id": "",
+        "tipo_arquivo": "application/pdf",
+        "status": "mapeada",
+        "created_at": agora
+    })
+    await db.areas_criticas.insert_many([
+        {
+            "area_id": f"area_{uuid.uuid4().hex[:12]}",
+            "planta_id": planta_id,
+            "nome": f"Área {i}",
+            "tipo_area": tipos[i % len(tipos)],
+            "posicao_x": 0.0,
+            "posicao_y": 0.0,
+            "criticidade": "media",
+            "created_at": agora
+        }
+        for i in range(total_areas)
+    ])
+    return empresa_id, planta_id
+
+async def limpar_bench(db, user_id: str, empresa_ids: list, planta_ids: list):
+    inspecao_ids = await db.auto_inspecoes.distinct("inspecao_id", {"planta_id": {"$in": planta_ids}})
+    await db.inspecao_itens.delete_many({"inspecao_id": {"$in": inspecao_ids}})
+    await db.alertas.delete_many({"inspecao_id": {"$in": inspecao_ids}})
+    await db.auto_inspecoes.delete_many({"planta_id": {"$in": planta_ids}})
+    await db.areas_criticas.delete_many({"planta_id": {"$in": planta_ids}})
+    await db.plantas_estabelecimento.delete_many({"planta_id": {"$in": planta_ids}})
+    await db.empresas.delete_many({"empresa_id": {"$in": empresa_ids}})
+    await db.user_sessions.delete_many({"user_id": user_id})
+
+async def bench_login(total: int, concorrencia: int):
+    # O usuário do stand-in precisa existir para logar sem código de convite
+    db = conectar_db()
+    user_id, _ = await criar_sessao_bench(db)
+    semaforo = asyncio.Semaphore(concorrencia)
+    latencias = []
+    erros = 0
+
+    try:
+        async with httpx.AsyncClient(base_url=BACKEND_URL, timeout=30) as http:
+            async def login():
+                nonlocal erros
+                async with semaforo:
+                    inicio = time.perf_counter()
+                    resp = await http.post("/auth/session", json={"session_id": uuid.uuid4().hex})
+                    if resp.status_code == 200:
+                        latencias.append(time.perf_counter() - inicio)
+                    else:
+                        erros += 1
+
+            inicio = time.perf_counter()
+            await asyncio.gather(*(login() for _ in range(total)))
+            resumo("login", latencias, erros, time.perf_counter() - inicio)
+    finally:
+        await db.user_sessions.delete_many({"user_id": user_id})
+
+async def bench_inspecao(tamanhos: list, repeticoes: int):
+    db = conectar_db()
+    user_id, session_token = await criar_sessao_bench(db)
+    empresa_ids, planta_ids = [], []
+    headers = {"Authorization": f"Bearer {session_token}"}
+
+    try:
+        async with httpx.AsyncClient(base_url=BACKEND_URL, timeout=120, headers=headers) as http:
+            for total_areas in tamanhos:
+                empresa_id, planta_id = await criar_planta_bench(db, user_id, total_areas)
+                empresa_ids.append(empresa_id)
+                planta_ids.append(planta_id)
+
+                latencias = []
+                erros = 0
+                inicio = time.perf_counter()
+                for _ in range(repeticoes):
+                    t0 = time.perf_counter()
+                    resp = await http.post(
+                        "/inspecoes",
+                        params={"empresa_id": empresa_id, "planta_id": planta_id}
+                    )
+                    if resp.status_code == 200:
+                        latencias.append(time.perf_counter() - t0)
+                    else:
+                        erros += 1
+                resumo(f"inspecao ({total_areas} áreas)", latencias, erros, time.perf_counter() - inicio)
+    finally:
+        await limpar_bench(db, user_id, empresa_ids, planta_ids)
+
+async def criar_inspecao_bench(db, planta_id: str, empresa_id: str, total_itens: int) -> str:
+    """Grava diretamente uma inspeção com exatamente total_itens itens"""
+    areas = await db.areas_criticas.find({"planta_id": planta_id}, {"_id": 0, "area_id": 1}).to_list(None)
+    checklist_ids = await db.checklist_items.distinct("item_id") or ["chk_bench"]
+    inspecao_id = f"insp_{uuid.uuid4().hex[:12]}"
+    agora = datetime.now(timezone.utc)
+    await db.inspecao_itens.insert_many([
+        {
+            "item_inspecao_id": f"itinsp_{uuid.uuid4().hex[:12]}",
+            "inspecao_id": inspecao_id,
+            "area_critica_id": areas[i % len(areas)]["area_id"],
+            "checklist_item_id": checklist_ids[i % len(checklist_ids)],
+            "resposta": None,
+            "foto_id": None,
+            "observacao": None,
+            "risco_detectado": False,
+            "data_resposta": None,
+            "ordem": i
+        }
+        for i in range(total_itens)
+    ])
+    await db.auto_inspecoes.insert_one({
+        "inspecao_id": inspecao_id,
+        "empresa_id": empresa_id,
+        "planta_id": planta_id,
+        "data_inspecao": agora,
+        "status": "em_andamento",
+        "total_itens": total_itens,
+        "itens_conformes": 0,
+        "itens_nao_conformes": 0,
+        "created_at": agora
+    })
+    return inspecao_id
+
+async def bench_itens(tamanhos: list, repeticoes: int):
+    db = conectar_db()
+    user_id, session_token = await criar_sessao_bench(db)
+    empresa_ids, planta_ids = [], []
+    headers = {"Authorization": f"Bearer {session_token}"}
+
+    try:
+        async with httpx.AsyncClient(base_url=BACKEND_URL, timeout=120, headers=headers) as http:
+            for total_itens in tamanhos:
+                empresa_id, planta_id = await criar_planta_bench(db, user_id, max(total_itens // 5, 1))
+                empresa_ids.append(empresa_id)
+                planta_ids.append(planta_id)
+                inspecao_id = await criar_inspecao_bench(db, planta_id, empresa_id, total_itens)
+
+                latencias = []
+                erros = 0
+                consultas = []
+                inicio = time.perf_counter()
+                for _ in range(repeticoes):
+                    antes = await contar_consultas(db)
+                    t0 = time.perf_counter()
+                    resp = await http.get(f"/inspecoes/{inspecao_id}/items")
+                    if resp.status_code == 200:
+                        latencias.append(time.perf_counter() - t0)
+                    else:
+                        erros += 1
+                    consultas.append(await contar_consultas(db) - antes)
+                resumo(f"itens ({total_itens} itens)", latencias, erros, time.perf_counter() - inicio)
+                print(f"   consultas por requisição: {statistics.median(consultas):.0f}")
+    finally:
+        await limpar_bench(db, user_id, empresa_ids, planta_ids)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cenario", choices=["login", "inspecao", "itens"])
+    parser.add_argument("--requests", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--sizes", default=None)
+    args = parser.parse_args()
+    tamanhos = [int(t) for t in args.sizes.split(",")] if args.sizes else None
+
+    if args.cenario == "login":
+        asyncio.run(bench_login(args.requests or 500, args.concurrency))
+    elif args.cenario == "inspecao":
+        asyncio.run(bench_inspecao(tamanhos or [10, 100, 1000], args.requests or 5))
+    elif args.cenario == "itens":
+        asyncio.run(bench_itens(tamanhos or [100, 1000], args.requests or 20))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Deduplicação dos arquivos já existentes no GridFS.
+
+Calcula o SHA-256 de cada arquivo original (derivados de imagem e relatórios
+em cache são ignorados), agrupa conteúdos idênticos e informa quanto espaço pode ser
+recuperado. Com --aplicar, aponta todas as referências para uma única cópia,
+apaga as demais (com seus derivados) e registra cada conteúdo em `blobs` com
+a contagem de referências, como faz o upload deduplicado do server.py.
+
+Uso:
+    python deduplicar_blobs.py            # apenas relatório
+    python deduplicar_blobs.py --aplicar
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from bson import ObjectId
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url)
+db = client[os.environ['DB_NAME']]
+fs = AsyncIOMotorGridFSBucket(db)
+
+# Campos que referenciam arquivos do GridFS: (coleção, campo)
+REFERENCIAS = [
+    ("plantas_estabelecimento", "arquivo_id"),
+    ("areas_criticas", "foto_cliente_id"),
+    ("inspecao_itens", "foto_id"),
+    ("licencas_documentos", "arquivo_id"),
+]
+
+def formatar_bytes(total: int) -> str:
+    for unidade in ["B", "KB", "MB", "GB"]:
+        if total < 1024:
+            return f"{total:.1f} {unidade}"
+        total /= 1024
+    return f"{total:.1f} TB"
+
+async def calcular_sha256(arquivo_id: ObjectId) -> str:
+    grid_out = await fs.open_download_stream(arquivo_id)
+    sha256 = hashlib.sha256()
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            break
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+async def contar_referencias(arquivo_id: str) -> int:
+    total = 0
+    for colecao, campo in REFERENCIAS:
+        total += await db[colecao].count_documents({campo: arquivo_id})
+    return total
+
+async def apagar_arquivo(arquivo_id: str):
+    derivados = await db.derivados_imagem.find({"original_id": arquivo_id}, {"_id": 0}).to_list(None)
+    await db.derivados_imagem.delete_many({"original_id": arquivo_id})
+    for arquivo in [arquivo_id] + [d["arquivo_id"] for d in derivados]:
+        await fs.delete(ObjectId(arquivo))
+
+async def deduplicar(aplicar: bool):
+    digests_registrados = {
+        b["arquivo_id"]: b["sha256"]
+        for b in await db.blobs.find({}, {"_id": 0, "arquivo_id": 1, "sha256": 1}).to_list(None)
+    }
+
+    grupos = defaultdict(list)
+    total_arquivos = 0
+    async for arquivo in db["fs.files"].find(
+        {"metadata.derivado_de": {"$exists": False}, "metadata.relatorio_ticket_id": {"$exists": False}},
+        {"_id": 1, "length": 1, "uploadDate": 1}
+    ).sort("uploadDate", 1):
+        total_arquivos += 1
+        arquivo_id = str(arquivo["_id"])
+        sha256 = digests_registrados.get(arquivo_id) or await calcular_sha256(arquivo["_id"])
+        grupos[sha256].append((arquivo_id, arquivo["length"]))
+
+    duplicados = 0
+    bytes_recuperaveis = 0
+    for sha256, arquivos in grupos.items():
+        # Mantém a cópia já registrada em blobs ou, na falta dela, a mais antiga
+        arquivos.sort(key=lambda a: a[0] not in digests_registrados)
+        canonico, tamanho = arquivos[0]
+        copias = arquivos[1:]
+        duplicados += len(copias)
+        bytes_recuperaveis += sum(t for _, t in copias)
+
+        if not aplicar:
+            continue
+
+        for copia, _ in copias:
+            for colecao, campo in REFERENCIAS:
+                await db[colecao].update_many({campo: copia}, {"$set": {campo: canonico}})
+            await apagar_arquivo(copia)
+
+        await db.blobs.update_one(
+            {"sha256": sha256},
+            {
+                "$set": {"arquivo_id": canonico, "tamanho": tamanho, "refs": await contar_referencias(canonico)},
+                "$setOnInsert": {"created_at": datetime.now(timezone.utc)}
+            },
+            upsert=True
+        )
+
+    print(f"Arquivos analisados: {total_arquivos}")
+    print(f"Conteúdos distintos: {len(grupos)}")
+    print(f"Cópias duplicadas: {duplicados}")
+    acao = "Espaço recuperado" if aplicar else "Espaço recuperável"
+    print(f"{acao}: {formatar_bytes(bytes_recuperaveis)}")
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--aplicar", action="store_true", help="remove as cópias duplicadas")
+    args = parser.parse_args()
+    await deduplicar(args.aplicar)
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+"""
+Provedor de email local para testes de vazão das notificações.
+
+Responde ao mesmo endpoint de envio do Resend, sem rede externa, e conta os
+emails recebidos (no total e por destinatário, com os assuntos).
+Uso:
+    uvicorn email_standin:app --port 8098
+    RESEND_API_URL=http://localhost:8098 RESEND_API_KEY=re_standin uvicorn server:app
+"""
+import asyncio
+import os
+import random
+import uuid
+from fastapi import FastAPI, Request, HTTPException
+
+# Latência artificial do provedor (segundos) para simular upstream lento
+LATENCIA = float(os.environ.get('EMAIL_STANDIN_LATENCY', '0'))
+# Fração das requisições que falham com 500, para exercitar as retentativas
+TAXA_FALHA = float(os.environ.get('EMAIL_STANDIN_FAILURE_RATE', '0'))
+
+app = FastAPI()
+recebidos = {"total": 0, "falhas": 0, "por_destinatario": {}}
+
+@app.post("/emails")
+async def enviar(request: Request):
+    if not request.headers.get("Authorization"):
+        raise HTTPException(status_code=401, detail="Missing API key")
+    params = await request.json()
+    if LATENCIA:
+        await asyncio.sleep(LATENCIA)
+    if TAXA_FALHA and random.random() < TAXA_FALHA:
+        recebidos["falhas"] += 1
+        raise HTTPException(status_code=500, detail="Falha simulada")
+    recebidos["total"] += 1
+    for destinatario in params.get("to") or []:
+        recebidos["por_destinatario"].setdefault(destinatario.lower(), []).append(params.get("subject"))
+    return {"id": str(uuid.uuid4()), "to": params.get("to")}
+
+@app.get("/contagem")
+async def contagem():
+    return recebidos
@@ -0,0 +1,18 @@
+"""
+Processamento de imagens executado no pool de processos do server.py.
+
+Fica num módulo à parte porque os workers são criados com "spawn": cada um
+importa só este arquivo, sem carregar o app nem o cliente do Mongo.
+"""
+import io
+from PIL import Image, ImageOps
+
+
+def redimensionar_imagem(conteudo: bytes, tamanho: int, formato: str) -> bytes:
+    """Reduz a imagem para caber em tamanho x tamanho"""
+    with Image.open(io.BytesIO(conteudo)) as imagem:
+        imagem = ImageOps.exif_transpose(imagem).convert("RGB")
+        imagem.thumbnail((tamanho, tamanho))
+        saida = io.BytesIO()
+        imagem.save(saida, format=formato, quality=82)
+        return saida.getvalue()
@@ -0,0 +1,34 @@
+"""
+Servidor OAuth local para benchmarks de login.
+
+Responde ao mesmo endpoint de session-data do provedor real, sem rede externa.
+Uso:
+    uvicorn oauth_standin:app --port 8099
+    OAUTH_BASE_URL=http://localhost:8099 uvicorn server:app
+"""
+import asyncio
+import os
+from fastapi import FastAPI, Request, HTTPException
+
+# Latência artificial do provedor (segundos) para simular upstream lento
+LATENCIA = float(os.environ.get('OAUTH_STANDIN_LATENCY', '0'))
+# Identidade dedicada ao benchmark, para não tocar no perfil nem nas sessões
+# de usuários reais; benchmark.py cria o usuário antes (dispensa convite)
+EMAIL = os.environ.get('OAUTH_STANDIN_EMAIL', 'bench@ecoguard.invalid')
+
+app = FastAPI()
+
+@app.get("/auth/v1/env/oauth/session-data")
+async def session_data(request: Request):
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=401, detail="Missing session id")
+    if LATENCIA:
+        await asyncio.sleep(LATENCIA)
+    return {
+        "id": session_id,
+        "email": EMAIL,
+        "name": "Usuário Benchmark",
+        "picture": None,
+        "session_token": f"bench_{session_id}"
+    }
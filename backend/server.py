@@ -3,6 +3,8 @@ from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from datetime import datetime, timezone, timedelta
 import os
 import logging
@@ -10,11 +12,26 @@ import asyncio
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional, Dict, Any
+from collections import OrderedDict, deque
 import uuid
+import re
+import time
+import random
+import socket
+import hmac
+import json
+import base64
+import hashlib
+import heapq
 import gridfs
 import io
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import httpx
 import resend
+from imagens import redimensionar_imagem
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -26,6 +43,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Tarefas disparadas sem await ficam referenciadas aqui até terminarem; o
+# event loop só guarda referência fraca e poderia coletá-las no meio.
+_tarefas_background: set = set()
+
+def em_background(coro) -> asyncio.Task:
+    tarefa = asyncio.create_task(coro)
+    _tarefas_background.add(tarefa)
+    tarefa.add_done_callback(_tarefas_background.discard)
+    return tarefa
+
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
@@ -253,6 +280,10 @@ class CodigoConvite(BaseModel):
     created_at: datetime
     expires_at: Optional[datetime] = None
 
+# Limite de dias_alerta_vencimento; também é o horizonte das consultas de
+# alerta e do job de status, que só olham licenças vencendo dentro dele.
+ALERTA_HORIZONTE_MAXIMO_DIAS = 180
+
 class LicencaDocumento(BaseModel):
     model_config = ConfigDict(extra="ignore")
     licenca_id: str
@@ -278,7 +309,7 @@ class LicencaDocumentoCreate(BaseModel):
     orgao_emissor: str
     data_emissao: str
     data_validade: str
-    dias_alerta_vencimento: int = 30
+    dias_alerta_vencimento: int = Field(30, ge=1, le=ALERTA_HORIZONTE_MAXIMO_DIAS)
     observacoes: Optional[str] = None
 
 class LicencaDocumentoUpdate(BaseModel):
@@ -288,7 +319,7 @@ class LicencaDocumentoUpdate(BaseModel):
     orgao_emissor: Optional[str] = None
     data_emissao: Optional[str] = None
     data_validade: Optional[str] = None
-    dias_alerta_vencimento: Optional[int] = None
+    dias_alerta_vencimento: Optional[int] = Field(None, ge=1, le=ALERTA_HORIZONTE_MAXIMO_DIAS)
     observacoes: Optional[str] = None
 
 # Auth Helper
@@ -298,49 +329,399 @@ SENDER_EMAIL = f"EcoGuard <{ADMIN_EMAIL}>"
 # Configure Resend
 resend.api_key = os.environ.get('RESEND_API_KEY')
 
-async def enviar_email_notificacao(destinatario_email: str, assunto: str, mensagem: str):
-    """Envia email de notificação usando Resend"""
-    try:
-        if not resend.api_key:
-            logger.warning("RESEND_API_KEY não configurada. Email não enviado.")
+async def enviar_email_resend(destinatario_email: str, assunto: str, mensagem: str) -> bool:
+    """Envia email de notificação usando Resend; erros do provedor são propagados.
+
+    Retorna False quando o envio está desabilitado (sem RESEND_API_KEY).
+    """
+    if not resend.api_key:
+        logger.warning("RESEND_API_KEY não configurada. Email não enviado.")
+        return False
+    
+    html_content = f"""
+    <html>
+    <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
+        <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+            <h2 style="color: #16a34a; margin-bottom: 20px;">🌿 EcoGuard - Sistema de Auto-Fiscalização</h2>
+            <p style="font-size: 16px; color: #333; line-height: 1.6;">{mensagem}</p>
+            <hr style="border: none; border-top: 1px solid #eee; margin: 20px 0;">
+            <p style="font-size: 12px; color: #666;">Este é um email automático. Não responda diretamente.</p>
+        </div>
+    </body>
+    </html>
+    """
+    
+    params = {
+        "from": SENDER_EMAIL,
+        "to": [destinatario_email],
+        "subject": assunto,
+        "html": html_content
+    }
+    
+    await asyncio.to_thread(resend.Emails.send, params)
+    logger.info(f"📧 Email enviado para {destinatario_email}: {assunto}")
+    return True
+
+class NotificationDispatcher:
+    """Fila limitada de emails atendida por um pool de workers.
+
+    Os handlers só enfileiram (enviar_email_notificacao), então a latência do
+    provedor não entra no tempo de resposta da API. Falhas são repetidas com
+    backoff exponencial e jitter; com a fila cheia a notificação é descartada
+    e contabilizada. ao_entregar, se informado, só é chamado depois de uma
+    entrega confirmada pelo provedor e ao_falhar quando ela não acontece; sem
+    RESEND_API_KEY nada é entregue e o email conta como ignorado. No shutdown a fila é drenada por até
+    NOTIFICACOES_DRENO_TIMEOUT segundos. Para testes de vazão, aponte
+    RESEND_API_URL para email_standin.py.
+    """
+
+    def __init__(self, max_fila: int, workers: int, max_tentativas: int, backoff_base: float):
+        self.max_fila = max_fila
+        self.num_workers = max(workers, 1)
+        self.max_tentativas = max(max_tentativas, 1)
+        self.backoff_base = backoff_base
+        self._fila: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._latencias = deque(maxlen=1000)
+        self.enfileiradas = 0
+        self.enviadas = 0
+        self.retentativas = 0
+        self.falhas = 0
+        self.descartadas = 0
+        self.ignoradas = 0
+
+    def iniciar(self):
+        if self._workers:
             return
-        
-        html_content = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                <h2 style="color: #16a34a; margin-bottom: 20px;">🌿 EcoGuard - Sistema de Auto-Fiscalização</h2>
-                <p style="font-size: 16px; color: #333; line-height: 1.6;">{mensagem}</p>
-                <hr style="border: none; border-top: 1px solid #eee; margin: 20px 0;">
-                <p style="font-size: 12px; color: #666;">Este é um email automático. Não responda diretamente.</p>
-            </div>
-        </body>
-        </html>
-        """
-        
-        params = {
-            "from": SENDER_EMAIL,
-            "to": [destinatario_email],
-            "subject": assunto,
-            "html": html_content
+        self._fila = asyncio.Queue(maxsize=self.max_fila)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+
+    def enfileirar(self, destinatario: str, assunto: str, mensagem: str, ao_entregar=None, ao_falhar=None) -> bool:
+        if not self._workers:
+            self.iniciar()
+        try:
+            self._fila.put_nowait((destinatario, assunto, mensagem, ao_entregar, ao_falhar))
+        except asyncio.QueueFull:
+            self.descartadas += 1
+            logger.error(f"Fila de notificações cheia; email para {destinatario} descartado: {assunto}")
+            return False
+        self.enfileiradas += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            destinatario, assunto, mensagem, ao_entregar, ao_falhar = await self._fila.get()
+            try:
+                entregue = await self._entregar(destinatario, assunto, mensagem)
+                retorno = ao_entregar if entregue else ao_falhar
+                if retorno:
+                    try:
+                        await retorno()
+                    except Exception as e:
+                        logger.error(f"Erro ao concluir envio de email para {destinatario}: {e}")
+            finally:
+                self._fila.task_done()
+
+    async def _entregar(self, destinatario: str, assunto: str, mensagem: str) -> bool:
+        for tentativa in range(self.max_tentativas):
+            inicio = time.perf_counter()
+            try:
+                entregue = await enviar_email_resend(destinatario, assunto, mensagem)
+            except Exception as e:
+                if tentativa + 1 >= self.max_tentativas:
+                    self.falhas += 1
+                    logger.error(f"Erro ao enviar email para {destinatario} após {tentativa + 1} tentativas: {e}")
+                    return False
+                self.retentativas += 1
+                await asyncio.sleep(self.backoff_base * (2 ** tentativa) * (0.5 + random.random() / 2))
+                continue
+            if not entregue:
+                self.ignoradas += 1
+                return False
+            self._latencias.append(time.perf_counter() - inicio)
+            self.enviadas += 1
+            return True
+        return False
+
+    async def drenar(self, timeout: float):
+        """Aguarda a fila esvaziar (até timeout) e encerra os workers"""
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._fila.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dreno de notificações expirou com {self._fila.qsize()} emails na fila")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> Dict[str, Any]:
+        latencias = sorted(self._latencias)
+        return {
+            "workers": len(self._workers),
+            "fila": self._fila.qsize() if self._fila else 0,
+            "max_fila": self.max_fila,
+            "enfileiradas": self.enfileiradas,
+            "enviadas": self.enviadas,
+            "retentativas": self.retentativas,
+            "falhas": self.falhas,
+            "descartadas": self.descartadas,
+            "ignoradas": self.ignoradas,
+            "latencia_p50_ms": round(latencias[len(latencias) // 2] * 1000, 1) if latencias else None,
+            "latencia_p95_ms": round(latencias[max(int(len(latencias) * 0.95) - 1, 0)] * 1000, 1) if latencias else None
         }
-        
-        email = await asyncio.to_thread(resend.Emails.send, params)
-        logger.info(f"📧 Email enviado para {destinatario_email}: {assunto}")
-        return email
-    except Exception as e:
-        logger.error(f"Erro ao enviar email: {e}")
 
-async def get_current_user(request: Request) -> User:
+NOTIFICACOES_DRENO_TIMEOUT = float(os.environ.get('NOTIFICACOES_DRENO_TIMEOUT', '10'))
+notificacoes = NotificationDispatcher(
+    max_fila=int(os.environ.get('NOTIFICACOES_FILA_MAX', '1000')),
+    workers=int(os.environ.get('NOTIFICACOES_WORKERS', '4')),
+    max_tentativas=int(os.environ.get('NOTIFICACOES_MAX_TENTATIVAS', '4')),
+    backoff_base=float(os.environ.get('NOTIFICACOES_BACKOFF_SECONDS', '1'))
+)
+
+def enviar_email_notificacao(destinatario_email: str, assunto: str, mensagem: str, ao_entregar=None, ao_falhar=None) -> bool:
+    """Enfileira um email de notificação; o envio acontece em background"""
+    return notificacoes.enfileirar(destinatario_email, assunto, mensagem, ao_entregar, ao_falhar)
+
+class SessionCache:
+    """Cache LRU em memória de session_token -> User, com TTL.
+
+    Evita as duas consultas ao Mongo (user_sessions + users) que todo endpoint
+    faz em get_current_user. Cada entrada expira no que vier primeiro: o TTL do
+    cache ou o expires_at da sessão. Como o cache é por processo, logout e
+    exclusão de usuário só invalidam localmente; o TTL limita o tempo em que
+    outros workers ainda aceitam a sessão.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, session_token: str) -> Optional[User]:
+        entry = self._entries.get(session_token)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, expires_at, deadline = entry
+        if time.monotonic() >= deadline or expires_at < datetime.now(timezone.utc):
+            del self._entries[session_token]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(session_token)
+        self.hits += 1
+        return user
+
+    def set(self, session_token: str, user: User, expires_at: datetime):
+        if not self.enabled:
+            return
+        self._entries[session_token] = (user, expires_at, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(session_token)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, session_token: str):
+        if self._entries.pop(session_token, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_user(self, user_id: str):
+        tokens = [t for t, (u, _, _) in self._entries.items() if u.user_id == user_id]
+        for token in tokens:
+            del self._entries[token]
+        self.invalidations += len(tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+session_cache = SessionCache(
+    max_entries=int(os.environ.get('SESSION_CACHE_MAX_ENTRIES', '10000')),
+    ttl_seconds=float(os.environ.get('SESSION_CACHE_TTL_SECONDS', '60'))
+)
+
+# Sessões assinadas (stateless)
+# SESSION_MODE=signed faz o create_session emitir um token HMAC com user_id,
+# role e expiração; get_current_user valida a assinatura sem ir ao Mongo e só
+# consulta o conjunto de revogações mantido em memória.
+SESSION_MODE = os.environ.get('SESSION_MODE', 'database')  # database | signed
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')
+SESSION_TTL = timedelta(days=7)
+SIGNED_TOKEN_PREFIX = "v1."
+REVOCATION_REFRESH_SECONDS = float(os.environ.get('SESSION_REVOCATION_REFRESH_SECONDS', '30'))
+
+if SESSION_MODE == "signed" and not SESSION_SECRET:
+    logger.warning("SESSION_MODE=signed sem SESSION_SECRET. Usando sessões no banco.")
+    SESSION_MODE = "database"
+
+def _b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _assinar(payload_b64: str) -> str:
+    digest = hmac.new(SESSION_SECRET.encode(), payload_b64.encode(), hashlib.sha256).digest()
+    return _b64url_encode(digest)
+
+def emitir_token_assinado(user_doc: dict, expires_at: datetime) -> str:
+    """Gera token assinado no formato v1.<payload>.<assinatura>"""
+    payload = {
+        "jti": uuid.uuid4().hex[:16],
+        "uid": user_doc["user_id"],
+        "email": user_doc["email"],
+        "name": user_doc["name"],
+        "picture": user_doc.get("picture"),
+        "cat": user_doc["created_at"].isoformat(),
+        "role": "gestor" if user_doc["email"] in GESTORES_EMAILS else "cliente",
+        "iat": int(time.time()),
+        "exp": int(expires_at.timestamp())
+    }
+    payload_b64 = _b64url_encode(json.dumps(payload, separators=(",", ":")).encode())
+    return f"{SIGNED_TOKEN_PREFIX}{payload_b64}.{_assinar(payload_b64)}"
+
+def verificar_token_assinado(session_token: str) -> dict:
+    """Valida assinatura e expiração; retorna o payload do token"""
+    if not SESSION_SECRET:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    try:
+        payload_b64, assinatura = session_token[len(SIGNED_TOKEN_PREFIX):].split(".")
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    # compare_digest com str só aceita ASCII; em bytes, assinatura adulterada com
+    # outros caracteres é só uma assinatura inválida (401), não um TypeError
+    if not hmac.compare_digest(assinatura.encode(), _assinar(payload_b64).encode()):
+        raise HTTPException(status_code=401, detail="Invalid session")
+    payload = json.loads(_b64url_decode(payload_b64))
+    if payload["exp"] < time.time():
+        raise HTTPException(status_code=401, detail="Session expired")
+    return payload
+
+class RevocationSet:
+    """Cópia em memória da coleção sessoes_revogadas.
+
+    Guarda jtis revogados por logout e, por usuário, o instante a partir do qual
+    todos os tokens emitidos antes dele deixam de valer (exclusão de usuário).
+    Os documentos expiram junto com o token mais longo que poderiam bloquear,
+    então o conjunto fica pequeno. É recarregado a cada
+    REVOCATION_REFRESH_SECONDS; revogações feitas neste processo valem na hora.
+    """
+
+    def __init__(self):
+        self.jtis: set = set()
+        self.users: Dict[str, int] = {}
+        self.refreshed_at: Optional[datetime] = None
+
+    def is_revoked(self, payload: dict) -> bool:
+        if payload["jti"] in self.jtis:
+            return True
+        revogado_em = self.users.get(payload["uid"])
+        return revogado_em is not None and payload["iat"] <= revogado_em
+
+    async def refresh(self):
+        docs = await db.sessoes_revogadas.find(
+            {"expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 0, "jti": 1, "user_id": 1, "revogado_em": 1}
+        ).to_list(None)
+        jtis = set()
+        users = {}
+        for doc in docs:
+            if doc.get("jti"):
+                jtis.add(doc["jti"])
+            else:
+                ts = int(doc["revogado_em"].replace(tzinfo=timezone.utc).timestamp())
+                users[doc["user_id"]] = max(ts, users.get(doc["user_id"], 0))
+        self.jtis = jtis
+        self.users = users
+        self.refreshed_at = datetime.now(timezone.utc)
+
+    async def revoke_token(self, payload: dict):
+        self.jtis.add(payload["jti"])
+        await db.sessoes_revogadas.insert_one({
+            "jti": payload["jti"],
+            "user_id": payload["uid"],
+            "revogado_em": datetime.now(timezone.utc),
+            "expires_at": datetime.fromtimestamp(payload["exp"], timezone.utc)
+        })
+
+    async def revoke_user(self, user_id: str):
+        agora = datetime.now(timezone.utc)
+        self.users[user_id] = int(agora.timestamp())
+        await db.sessoes_revogadas.insert_one({
+            "jti": None,
+            "user_id": user_id,
+            "revogado_em": agora,
+            "expires_at": agora + SESSION_TTL
+        })
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": SESSION_MODE,
+            "revoked_tokens": len(self.jtis),
+            "revoked_users": len(self.users),
+            "refreshed_at": self.refreshed_at.isoformat() if self.refreshed_at else None
+        }
+
+revocation_set = RevocationSet()
+
+async def atualizar_revogacoes():
+    """Recarrega periodicamente o conjunto de sessões revogadas"""
+    while True:
+        try:
+            await revocation_set.refresh()
+        except Exception as e:
+            logger.error(f"Erro ao atualizar sessões revogadas: {e}")
+        await asyncio.sleep(REVOCATION_REFRESH_SECONDS)
+
+def get_session_token(request: Request) -> Optional[str]:
     session_token = request.cookies.get("session_token")
     if not session_token:
         auth_header = request.headers.get("Authorization")
         if auth_header and auth_header.startswith("Bearer "):
             session_token = auth_header.split(" ")[1]
+    return session_token
+
+async def get_current_user(request: Request) -> User:
+    session_token = get_session_token(request)
     
     if not session_token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        payload = verificar_token_assinado(session_token)
+        if revocation_set.is_revoked(payload):
+            raise HTTPException(status_code=401, detail="Invalid session")
+        return User(
+            user_id=payload["uid"],
+            email=payload["email"],
+            name=payload["name"],
+            picture=payload.get("picture"),
+            created_at=datetime.fromisoformat(payload["cat"])
+        )
+    
+    cached_user = session_cache.get(session_token)
+    if cached_user:
+        return cached_user
+    
     session_doc = await db.user_sessions.find_one(
         {"session_token": session_token},
         {"_id": 0}
@@ -365,11 +746,274 @@ async def get_current_user(request: Request) -> User:
     if not user_doc:
         raise HTTPException(status_code=401, detail="User not found")
     
-    return User(**user_doc)
+    user = User(**user_doc)
+    session_cache.set(session_token, user, expires_at)
+    return user
 
 def is_gestor(user: User) -> bool:
     return user.email in GESTORES_EMAILS
 
+# Índices do MongoDB
+# Catálogo declarativo aplicado em background no startup. create_index é
+# idempotente, então reaplicar o catálogo a cada deploy não custa nada.
+CATALOGO_INDICES = {
+    "users": [
+        {"keys": [("user_id", 1)], "unique": True},
+        {"keys": [("email", 1)]},
+        {"keys": [("created_at", -1), ("user_id", 1)]},
+    ],
+    "user_sessions": [
+        {"keys": [("session_token", 1)], "unique": True},
+        {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+        {"keys": [("user_id", 1), ("created_at", -1)]},
+    ],
+    "sessoes_revogadas": [
+        {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+    "codigos_convite": [
+        {"keys": [("codigo", 1)], "unique": True},
+        {"keys": [("created_at", -1)]},
+    ],
+    "clientes": [
+        {"keys": [("cliente_id", 1)], "unique": True},
+        {"keys": [("user_id", 1)]},
+    ],
+    "empresas": [
+        {"keys": [("empresa_id", 1)], "unique": True},
+        {"keys": [("user_id", 1)]},
+    ],
+    "plantas_estabelecimento": [
+        {"keys": [("planta_id", 1)], "unique": True},
+        {"keys": [("empresa_id", 1)]},
+    ],
+    "areas_criticas": [
+        {"keys": [("area_id", 1)], "unique": True},
+        {"keys": [("planta_id", 1)]},
+    ],
+    "checklist_items": [
+        {"keys": [("item_id", 1)], "unique": True},
+        {"keys": [("tipo_area", 1), ("ordem", 1)]},
+    ],
+    "auto_inspecoes": [
+        {"keys": [("inspecao_id", 1)], "unique": True},
+        {"keys": [("empresa_id", 1), ("data_inspecao", -1)]},
+    ],
+    "inspecao_itens": [
+        {"keys": [("item_inspecao_id", 1)], "unique": True},
+        {"keys": [("inspecao_id", 1), ("ordem", 1)]},
+    ],
+    "alertas": [
+        {"keys": [("alerta_id", 1)], "unique": True},
+        {"keys": [("inspecao_id", 1), ("status", 1)]},
+        {
+            "keys": [("inspecao_id", 1), ("item_inspecao_id", 1)],
+            "unique": True,
+            "partialFilterExpression": {"item_inspecao_id": {"$exists": True}}
+        },
+    ],
+    "tickets": [
+        {"keys": [("ticket_id", 1)], "unique": True},
+        {"keys": [("user_id", 1), ("created_at", -1), ("ticket_id", -1)]},
+        {"keys": [("created_at", -1), ("ticket_id", -1)]},
+        {"keys": [("etapa", 1), ("created_at", -1), ("ticket_id", -1)]},
+        {"keys": [("status", 1), ("created_at", -1), ("ticket_id", -1)]},
+        {"keys": [("empresa_id", 1), ("etapa", 1), ("ticket_id", 1)]},
+    ],
+    "ticket_mensagens": [
+        {"keys": [("mensagem_id", 1)], "unique": True},
+        {"keys": [("ticket_id", 1), ("created_at", 1)]},
+    ],
+    "licencas_documentos": [
+        {"keys": [("licenca_id", 1)], "unique": True},
+        {"keys": [("empresa_id", 1), ("data_validade", 1), ("licenca_id", 1)]},
+        {"keys": [("status", 1), ("data_validade", 1)]},
+        {"keys": [("empresa_id", 1), ("status", 1)]},
+        {"keys": [("data_validade", 1), ("licenca_id", 1)]},
+        {"keys": [("next_alert_at", 1)]},
+    ],
+    "condicionantes": [
+        {"keys": [("condicionante_id", 1)], "unique": True},
+        {"keys": [("licenca_id", 1), ("status", 1)]},
+        {"keys": [("data_acompanhamento", 1)]},
+        {"keys": [("next_alert_at", 1)]},
+    ],
+    "blobs": [
+        {"keys": [("sha256", 1)], "unique": True},
+        {"keys": [("arquivo_id", 1)], "unique": True},
+    ],
+    "relatorios_cache": [
+        {"keys": [("ticket_id", 1)], "unique": True},
+    ],
+    "fs.files": [
+        {"keys": [("metadata.relatorio_descartado_em", 1)], "sparse": True},
+    ],
+    "derivados_imagem": [
+        {"keys": [("original_id", 1), ("tamanho", 1)], "unique": True},
+    ],
+    "alertas_enviados": [
+        {"keys": [("alerta_key", 1)]},
+        {"keys": [("enviado_em", -1)]},
+    ],
+    "alertas_reservas": [
+        {"keys": [("alerta_key", 1)], "unique": True},
+        {"keys": [("expira_em", 1)], "expireAfterSeconds": 0},
+    ],
+}
+
+# Formatos de consulta usados pelos endpoints, verificados com explain() na
+# auditoria de índices: (coleção, filtro, ordenação)
+CONSULTAS_AUDITADAS = [
+    ("user_sessions", {"session_token": "x"}, None),
+    ("users", {"user_id": "x"}, None),
+    ("users", {"email": "x"}, None),
+    ("empresas", {"empresa_id": "x", "user_id": "x"}, None),
+    ("empresas", {"user_id": "x"}, None),
+    ("plantas_estabelecimento", {"planta_id": "x"}, None),
+    ("plantas_estabelecimento", {"empresa_id": "x"}, None),
+    ("areas_criticas", {"planta_id": "x"}, None),
+    ("checklist_items", {"tipo_area": "x"}, [("ordem", 1)]),
+    ("auto_inspecoes", {"empresa_id": "x"}, [("data_inspecao", -1)]),
+    ("inspecao_itens", {"inspecao_id": "x"}, [("ordem", 1)]),
+    ("alertas", {"inspecao_id": "x", "status": "pendente"}, None),
+    ("tickets", {"ticket_id": "x"}, None),
+    ("tickets", {"user_id": "x"}, [("created_at", -1), ("ticket_id", -1)]),
+    ("tickets", {}, [("created_at", -1), ("ticket_id", -1)]),
+    ("tickets", {"etapa": "x"}, [("created_at", -1), ("ticket_id", -1)]),
+    ("tickets", {"empresa_id": "x", "etapa": {"$ne": "finalizado"}}, None),
+    ("tickets", {"empresa_id": "x", "etapa": "finalizado"}, [("ticket_id", 1)]),
+    ("ticket_mensagens", {"ticket_id": "x"}, [("created_at", 1)]),
+    ("licencas_documentos", {"licenca_id": "x"}, None),
+    ("licencas_documentos", {"empresa_id": "x"}, None),
+    ("licencas_documentos", {"status": "x"}, None),
+    ("licencas_documentos", {"empresa_id": "x", "status": "x"}, None),
+    ("licencas_documentos", {"empresa_id": "x"}, [("data_validade", 1), ("licenca_id", 1)]),
+    ("licencas_documentos", {}, [("data_validade", 1), ("licenca_id", 1)]),
+    ("licencas_documentos", {"data_validade": {"$lte": datetime(2000, 1, 1)}}, None),
+    ("condicionantes", {"licenca_id": "x"}, None),
+    ("condicionantes", {"data_acompanhamento": {"$lte": datetime(2000, 1, 1)}}, None),
+    ("licencas_documentos", {"next_alert_at": {"$lte": datetime(2000, 1, 1)}}, None),
+    ("condicionantes", {"next_alert_at": {"$lte": datetime(2000, 1, 1)}}, None),
+    ("alertas_enviados", {"alerta_key": {"$in": ["x"]}}, None),
+    ("alertas_enviados", {}, [("enviado_em", -1)]),
+]
+
+async def aplicar_catalogo_indices():
+    """Cria os índices do catálogo; falhas são registradas sem interromper os demais"""
+    criados = 0
+    for colecao, indices in CATALOGO_INDICES.items():
+        for spec in indices:
+            opcoes = {k: v for k, v in spec.items() if k != "keys"}
+            try:
+                await db[colecao].create_index(spec["keys"], **opcoes)
+                criados += 1
+            except Exception as e:
+                logger.error(f"Erro ao criar índice {colecao} {spec['keys']}: {e}")
+    logger.info(f"🗂️  Catálogo de índices aplicado ({criados} índices)")
+
+def _estagios_plano(plano: dict) -> List[str]:
+    estagios = [plano.get("stage")]
+    if "inputStage" in plano:
+        estagios += _estagios_plano(plano["inputStage"])
+    for sub in plano.get("inputStages", []):
+        estagios += _estagios_plano(sub)
+    return [e for e in estagios if e]
+
+# Ciclo de vida das sessões
+# Sessões expiram pelo índice TTL em expires_at; o reaper periódico apenas
+# cobre o intervalo do monitor TTL do Mongo e documentos antigos.
+SESSION_MAX_PER_USER = int(os.environ.get('SESSION_MAX_PER_USER', '10'))
+SESSION_REAPER_INTERVAL = float(os.environ.get('SESSION_REAPER_INTERVAL_SECONDS', '3600'))
+
+async def registrar_sessao(user_id: str, session_token: str, expires_at: datetime):
+    """Grava (upsert) a sessão do login e aplica o limite de sessões por usuário"""
+    agora = datetime.now(timezone.utc)
+    await db.user_sessions.update_one(
+        {"session_token": session_token},
+        {
+            "$set": {"user_id": user_id, "expires_at": expires_at},
+            "$setOnInsert": {"created_at": agora}
+        },
+        upsert=True
+    )
+    await db.users.update_one({"user_id": user_id}, {"$set": {"last_login_at": agora}})
+    
+    excedentes = await db.user_sessions.find(
+        {"user_id": user_id},
+        {"_id": 0, "session_token": 1}
+    ).sort("created_at", -1).skip(SESSION_MAX_PER_USER).to_list(None)
+    if excedentes:
+        tokens = [s["session_token"] for s in excedentes]
+        await db.user_sessions.delete_many({"session_token": {"$in": tokens}})
+        for token in tokens:
+            session_cache.invalidate(token)
+
+async def limpar_sessoes_expiradas():
+    """Remove periodicamente sessões expiradas"""
+    while True:
+        try:
+            result = await db.user_sessions.delete_many(
+                {"expires_at": {"$lt": datetime.now(timezone.utc)}}
+            )
+            if result.deleted_count:
+                logger.info(f"🧹 {result.deleted_count} sessões expiradas removidas")
+        except Exception as e:
+            logger.error(f"Erro ao remover sessões expiradas: {e}")
+        await asyncio.sleep(SESSION_REAPER_INTERVAL)
+
+# Cliente OAuth
+# Um único httpx.AsyncClient por processo (criado no startup) mantém conexões
+# keep-alive com o provedor; OAUTH_BASE_URL permite apontar para um servidor
+# local (oauth_standin.py) em benchmarks de login.
+OAUTH_BASE_URL = os.environ.get('OAUTH_BASE_URL', 'https://demobackend.emergentagent.com').rstrip('/')
+OAUTH_SESSION_DATA_PATH = "/auth/v1/env/oauth/session-data"
+OAUTH_CONNECT_TIMEOUT = float(os.environ.get('OAUTH_CONNECT_TIMEOUT', '5'))
+OAUTH_READ_TIMEOUT = float(os.environ.get('OAUTH_READ_TIMEOUT', '10'))
+OAUTH_MAX_RETRIES = int(os.environ.get('OAUTH_MAX_RETRIES', '2'))
+OAUTH_MAX_CONNECTIONS = int(os.environ.get('OAUTH_MAX_CONNECTIONS', '50'))
+
+oauth_client: Optional[httpx.AsyncClient] = None
+
+def criar_oauth_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=OAUTH_BASE_URL,
+        timeout=httpx.Timeout(OAUTH_READ_TIMEOUT, connect=OAUTH_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=OAUTH_MAX_CONNECTIONS,
+            max_keepalive_connections=OAUTH_MAX_CONNECTIONS
+        )
+    )
+
+async def buscar_dados_sessao_oauth(session_id: str) -> dict:
+    """Consulta o provedor OAuth com timeout e retentativas limitadas.
+
+    Erros de transporte e respostas 5xx são repetidos até OAUTH_MAX_RETRIES
+    vezes com backoff exponencial; qualquer outra resposta != 200 é tratada
+    como session_id inválido.
+    """
+    global oauth_client
+    if oauth_client is None:
+        oauth_client = criar_oauth_client()
+    
+    for tentativa in range(OAUTH_MAX_RETRIES + 1):
+        try:
+            resp = await oauth_client.get(
+                OAUTH_SESSION_DATA_PATH,
+                headers={"X-Session-ID": session_id}
+            )
+        except httpx.TransportError as e:
+            logger.warning(f"Falha ao consultar provedor OAuth (tentativa {tentativa + 1}): {e}")
+        else:
+            if resp.status_code == 200:
+                return resp.json()
+            if resp.status_code < 500:
+                raise HTTPException(status_code=401, detail="Invalid session_id")
+            logger.warning(f"Provedor OAuth retornou {resp.status_code} (tentativa {tentativa + 1})")
+        
+        if tentativa < OAUTH_MAX_RETRIES:
+            await asyncio.sleep(0.2 * 2 ** tentativa)
+    
+    raise HTTPException(status_code=503, detail="Serviço de autenticação indisponível")
+
 # Auth Routes
 @api_router.post("/auth/session")
 async def create_session(request: Request, response: Response):
@@ -380,16 +1024,7 @@ async def create_session(request: Request, response: Response):
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id required")
     
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-            headers={"X-Session-ID": session_id}
-        )
-        
-        if resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid session_id")
-        
-        data = resp.json()
+    data = await buscar_dados_sessao_oauth(session_id)
     
     email = data["email"]
     
@@ -435,6 +1070,7 @@ async def create_session(request: Request, response: Response):
     
     if existing_user:
         user_id = existing_user["user_id"]
+        session_cache.invalidate_user(user_id)
         await db.users.update_one(
             {"user_id": user_id},
             {"$set": {
@@ -451,15 +1087,17 @@ async def create_session(request: Request, response: Response):
             "created_at": datetime.now(timezone.utc)
         })
     
-    session_token = data["session_token"]
-    expires_at = datetime.now(timezone.utc) + timedelta(days=7)
+    user_data = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+    expires_at = datetime.now(timezone.utc) + SESSION_TTL
     
-    await db.user_sessions.insert_one({
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": expires_at,
-        "created_at": datetime.now(timezone.utc)
-    })
+    if SESSION_MODE == "signed":
+        session_token = emitir_token_assinado(user_data, expires_at)
+    else:
+        session_token = data["session_token"]
+    
+    # Mesmo no modo assinado o login é registrado (último acesso, auditoria);
+    # só o caminho quente de autenticação deixa de consultar user_sessions.
+    await registrar_sessao(user_id, session_token, expires_at)
     
     response.set_cookie(
         key="session_token",
@@ -468,10 +1106,9 @@ async def create_session(request: Request, response: Response):
         secure=True,
         samesite="none",
         path="/",
-        max_age=7*24*60*60
+        max_age=int(SESSION_TTL.total_seconds())
     )
     
-    user_data = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     return user_data
 
 @api_router.get("/auth/me")
@@ -481,8 +1118,14 @@ async def get_me(request: Request):
 
 @api_router.post("/auth/logout")
 async def logout(request: Request, response: Response):
-    session_token = request.cookies.get("session_token")
+    session_token = get_session_token(request)
     if session_token:
+        if session_token.startswith(SIGNED_TOKEN_PREFIX):
+            try:
+                await revocation_set.revoke_token(verificar_token_assinado(session_token))
+            except HTTPException:
+                pass
+        session_cache.invalidate(session_token)
         await db.user_sessions.delete_one({"session_token": session_token})
     response.delete_cookie("session_token", path="/")
     return {"message": "Logged out"}
@@ -617,6 +1260,369 @@ async def delete_empresa(empresa_id: str, request: Request):
         raise HTTPException(status_code=404, detail="Empresa not found")
     return {"message": "Empresa deleted"}
 
+# Arquivos (GridFS)
+def _intervalo_range(range_header: str, tamanho: int) -> Optional[tuple]:
+    """Interpreta um header Range de intervalo único; None serve o arquivo inteiro"""
+    unidade, _, intervalo = range_header.partition("=")
+    if unidade.strip().lower() != "bytes" or "," in intervalo:
+        return None
+    inicio_str, _, fim_str = intervalo.strip().partition("-")
+    try:
+        if inicio_str:
+            inicio = int(inicio_str)
+            fim = min(int(fim_str), tamanho - 1) if fim_str else tamanho - 1
+        else:
+            # bytes=-N: últimos N bytes
+            sufixo = int(fim_str)
+            inicio = max(tamanho - sufixo, 0) if sufixo else tamanho
+            fim = tamanho - 1
+    except ValueError:
+        return None
+    if inicio > fim or inicio >= tamanho:
+        raise HTTPException(
+            status_code=416,
+            detail="Intervalo inválido",
+            headers={"Content-Range": f"bytes */{tamanho}"}
+        )
+    return inicio, fim
+
+async def _ler_gridfs(grid_out, inicio: int, tamanho: int):
+    grid_out.seek(inicio)
+    restante = tamanho
+    while restante > 0:
+        chunk = await grid_out.read(min(grid_out.chunk_size, restante))
+        if not chunk:
+            break
+        restante -= len(chunk)
+        yield chunk
+
+# Uploads: limites por tipo de endpoint (tamanho em MB configurável por env)
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Só tipos raster (e PDF para plantas) são aceitos: o arquivo é servido de
+# volta na origem da API, então SVG/HTML nunca podem entrar.
+TIPOS_IMAGEM_RASTER = {"image/jpeg", "image/png", "image/webp", "image/gif"}
+TIPOS_SERVIDOS_INLINE = TIPOS_IMAGEM_RASTER | {"application/pdf"}
+
+LIMITES_UPLOAD = {
+    "planta": {
+        "max_bytes": int(float(os.environ.get('UPLOAD_MAX_MB_PLANTA', '50')) * 1024 * 1024),
+        "tipos": TIPOS_IMAGEM_RASTER | {"application/pdf"}
+    },
+    "foto": {
+        "max_bytes": int(float(os.environ.get('UPLOAD_MAX_MB_FOTO', '15')) * 1024 * 1024),
+        "tipos": TIPOS_IMAGEM_RASTER
+    },
+}
+
+ASSINATURAS_ARQUIVO = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"%PDF", "application/pdf"),
+]
+
+def _tipo_pelo_conteudo(inicio: bytes) -> Optional[str]:
+    """Identifica o tipo real do arquivo pelos primeiros bytes, quando conhecido"""
+    for assinatura, tipo in ASSINATURAS_ARQUIVO:
+        if inicio.startswith(assinatura):
+            return tipo
+    if inicio[:4] == b"RIFF" and inicio[8:12] == b"WEBP":
+        return "image/webp"
+    if inicio[4:8] == b"ftyp":
+        # Marca principal + marcas compatíveis: mif1/msf1 são HEIF genéricos,
+        # então AVIF só é reconhecido pelas marcas avif/avis
+        tamanho_box = int.from_bytes(inicio[:4], "big")
+        marcas = {inicio[8:12]} | {inicio[i:i + 4] for i in range(16, min(tamanho_box, len(inicio)) - 3, 4)}
+        if marcas & {b"avif", b"avis"}:
+            return "image/avif"
+        if marcas & {b"heic", b"heix", b"hevc", b"hevx", b"mif1", b"msf1"}:
+            return "image/heic"
+        return "video/mp4"
+    return None
+
+async def salvar_upload_gridfs(arquivo: UploadFile, limite: str) -> str:
+    """Grava o upload no GridFS chunk a chunk, sem carregar o arquivo em memória.
+
+    Tipo declarado, tamanho informado e assinatura do primeiro chunk são
+    validados antes de gravar qualquer byte; o tamanho real é conferido
+    durante a cópia e o arquivo parcial é descartado se passar do limite.
+    O content_type gravado é o detectado pela assinatura, nunca o declarado.
+    """
+    max_bytes = LIMITES_UPLOAD[limite]["max_bytes"]
+    tipos = LIMITES_UPLOAD[limite]["tipos"]
+    content_type = (arquivo.content_type or "").split(";")[0].strip().lower()
+    if content_type == "image/jpg":
+        content_type = "image/jpeg"
+    
+    if content_type not in tipos:
+        raise HTTPException(status_code=415, detail=f"Tipo de arquivo não permitido: {content_type}")
+    if arquivo.size is not None and arquivo.size > max_bytes:
+        raise HTTPException(status_code=413, detail="Arquivo excede o tamanho máximo permitido")
+    
+    chunk = await arquivo.read(UPLOAD_CHUNK_SIZE)
+    tipo_detectado = _tipo_pelo_conteudo(chunk)
+    if tipo_detectado not in tipos:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Conteúdo do arquivo não permitido: {tipo_detectado or 'tipo não reconhecido'}"
+        )
+    
+    grid_in = fs.open_upload_stream(arquivo.filename, metadata={"content_type": tipo_detectado})
+    sha256 = hashlib.sha256()
+    total = 0
+    try:
+        while chunk:
+            total += len(chunk)
+            if total > max_bytes:
+                raise HTTPException(status_code=413, detail="Arquivo excede o tamanho máximo permitido")
+            sha256.update(chunk)
+            await grid_in.write(chunk)
+            chunk = await arquivo.read(UPLOAD_CHUNK_SIZE)
+        await grid_in.close()
+    except BaseException:
+        await grid_in.abort()
+        raise
+    
+    return await registrar_blob(str(grid_in._id), sha256.hexdigest(), total)
+
+# Blobs deduplicados por conteúdo
+# Cada arquivo enviado é identificado pelo SHA-256; um upload idêntico a um
+# blob existente reaproveita o arquivo (refs + 1) e descarta a cópia nova.
+async def registrar_blob(arquivo_id: str, sha256: str, tamanho: int) -> str:
+    """Retorna o arquivo_id a ser referenciado para o conteúdo com este digest"""
+    from bson import ObjectId
+    
+    existente = await db.blobs.find_one_and_update(
+        {"sha256": sha256},
+        {"$inc": {"refs": 1}},
+        projection={"_id": 0, "arquivo_id": 1}
+    )
+    if existente:
+        await fs.delete(ObjectId(arquivo_id))
+        return existente["arquivo_id"]
+    
+    try:
+        await db.blobs.insert_one({
+            "sha256": sha256,
+            "arquivo_id": arquivo_id,
+            "tamanho": tamanho,
+            "refs": 1,
+            "created_at": datetime.now(timezone.utc)
+        })
+    except DuplicateKeyError:
+        # Upload idêntico concluído ao mesmo tempo
+        return await registrar_blob(arquivo_id, sha256, tamanho)
+    return arquivo_id
+
+async def liberar_blob(arquivo_id: Optional[str]):
+    """Remove uma referência; sem referências, apaga o arquivo e seus derivados.
+
+    Arquivos sem registro em blobs (anteriores à deduplicação) são mantidos.
+    """
+    from bson import ObjectId
+    
+    if not arquivo_id:
+        return
+    blob = await db.blobs.find_one_and_update(
+        {"arquivo_id": arquivo_id},
+        {"$inc": {"refs": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not blob or blob["refs"] > 0:
+        return
+    
+    result = await db.blobs.delete_one({"arquivo_id": arquivo_id, "refs": {"$lte": 0}})
+    if result.deleted_count == 0:
+        return
+    derivados = await db.derivados_imagem.find({"original_id": arquivo_id}, {"_id": 0}).to_list(None)
+    await db.derivados_imagem.delete_many({"original_id": arquivo_id})
+    for arquivo in [arquivo_id] + [d["arquivo_id"] for d in derivados]:
+        try:
+            await fs.delete(ObjectId(arquivo))
+        except gridfs.NoFile:
+            pass
+
+# Derivados de imagem (miniaturas)
+# Gerados fora do event loop, em um pool de processos com Pillow, e gravados
+# no GridFS ao lado do original; derivados_imagem mapeia original -> derivado.
+TAMANHOS_DERIVADOS = (256, 1024)
+DERIVADOS_FORMATO = os.environ.get('DERIVADOS_FORMATO', 'JPEG').upper()  # JPEG | WEBP
+DERIVADOS_WORKERS = int(os.environ.get('DERIVADOS_WORKERS', '2'))
+
+_pool_imagens: Optional[ProcessPoolExecutor] = None
+
+async def gerar_derivado(original_id: str, tamanho: int) -> Optional[str]:
+    """Gera (se ainda não existir) o derivado de um tamanho; None se a imagem não puder ser lida.
+
+    Uma falha de decodificação fica marcada em metadata.derivado_falhou do
+    original, para que pedidos seguintes sirvam o original sem reprocessar.
+    """
+    global _pool_imagens
+    from bson import ObjectId
+    
+    existente = await db.derivados_imagem.find_one(
+        {"original_id": original_id, "tamanho": tamanho},
+        {"_id": 0, "arquivo_id": 1}
+    )
+    if existente:
+        return existente["arquivo_id"]
+    
+    if _pool_imagens is None:
+        # spawn: fork de um processo com threads (Motor, asyncio) não é seguro
+        _pool_imagens = ProcessPoolExecutor(
+            max_workers=DERIVADOS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    
+    try:
+        grid_out = await fs.open_download_stream(ObjectId(original_id))
+    except Exception as e:
+        logger.warning(f"Original {original_id} indisponível para derivado: {e}")
+        return None
+    if (grid_out.metadata or {}).get("derivado_falhou"):
+        return None
+    
+    try:
+        conteudo = await grid_out.read()
+        reduzida = await asyncio.get_running_loop().run_in_executor(
+            _pool_imagens, redimensionar_imagem, conteudo, tamanho, DERIVADOS_FORMATO
+        )
+    except BrokenProcessPool as e:
+        _pool_imagens = None
+        logger.error(f"Pool de imagens interrompido ao gerar derivado de {original_id}: {e}")
+        return None
+    except Exception as e:
+        logger.warning(f"Não foi possível gerar derivado {tamanho}px de {original_id}: {e}")
+        await db["fs.files"].update_one(
+            {"_id": grid_out._id},
+            {"$set": {"metadata.derivado_falhou": True}}
+        )
+        return None
+    
+    media_type = f"image/{DERIVADOS_FORMATO.lower()}"
+    arquivo_id = await fs.upload_from_stream(
+        f"{original_id}_{tamanho}.{DERIVADOS_FORMATO.lower()}",
+        reduzida,
+        metadata={"content_type": media_type, "derivado_de": original_id, "tamanho": tamanho}
+    )
+    
+    resultado = await db.derivados_imagem.find_one_and_update(
+        {"original_id": original_id, "tamanho": tamanho},
+        {"$setOnInsert": {
+            "arquivo_id": str(arquivo_id),
+            "formato": DERIVADOS_FORMATO,
+            "bytes": len(reduzida),
+            "created_at": datetime.now(timezone.utc)
+        }},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if resultado["arquivo_id"] != str(arquivo_id):
+        # Outra requisição gerou o mesmo derivado ao mesmo tempo
+        await fs.delete(arquivo_id)
+    return resultado["arquivo_id"]
+
+async def gerar_derivados(original_id: str):
+    for tamanho in TAMANHOS_DERIVADOS:
+        await gerar_derivado(original_id, tamanho)
+
+async def arquivo_para_tamanho(original_id: str, size: Optional[int]) -> str:
+    """Resolve o arquivo a servir para ?size=; gera o derivado sob demanda"""
+    if size is None:
+        return original_id
+    if size not in TAMANHOS_DERIVADOS:
+        raise HTTPException(status_code=400, detail=f"size deve ser um de {list(TAMANHOS_DERIVADOS)}")
+    return await gerar_derivado(original_id, size) or original_id
+
+# Arquivos do GridFS nunca mudam depois de gravados: o id do arquivo serve
+# como ETag forte. URLs cujo arquivo não pode ser trocado (planta) ou que
+# trazem ?v=<id da foto> recebem cache imutável; fotos podem ser substituídas
+# na mesma URL, então sem ?v= elas revalidam via ETag.
+CACHE_ARQUIVOS_MAX_AGE = int(os.environ.get('CACHE_ARQUIVOS_MAX_AGE', '31536000'))
+
+def _etag_corresponde(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    candidatos = [c.strip() for c in if_none_match.split(",")]
+    return any(c.removeprefix("W/") == etag for c in candidatos)
+
+async def servir_arquivo_gridfs(
+    arquivo_id: str,
+    request: Request,
+    media_type_padrao: str = "application/octet-stream",
+    nao_encontrado: str = "Arquivo não encontrado",
+    imutavel: bool = False,
+    headers_extras: Optional[Dict[str, str]] = None
+) -> Response:
+    """Envia um arquivo do GridFS em streaming, chunk a chunk, com suporte a Range e GET condicional"""
+    from bson import ObjectId
+    from bson.errors import InvalidId
+    from email.utils import format_datetime, parsedate_to_datetime
+    
+    etag = f'"{arquivo_id}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": (
+            f"private, immutable, max-age={CACHE_ARQUIVOS_MAX_AGE}" if imutavel
+            else "private, no-cache"
+        ),
+        # O navegador não pode reinterpretar o arquivo (ex.: como HTML)
+        "X-Content-Type-Options": "nosniff",
+        **(headers_extras or {})
+    }
+    
+    # If-None-Match é resolvido antes de qualquer acesso ao GridFS
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_corresponde(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    try:
+        grid_out = await fs.open_download_stream(ObjectId(arquivo_id))
+    except (InvalidId, gridfs.NoFile):
+        raise HTTPException(status_code=404, detail=nao_encontrado)
+    
+    upload_date = grid_out.upload_date.replace(tzinfo=timezone.utc)
+    headers["Last-Modified"] = format_datetime(upload_date, usegmt=True)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and not if_none_match:
+        try:
+            if upload_date.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since):
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    
+    tamanho = grid_out.length
+    metadata = grid_out.metadata or {}
+    media_type = metadata.get("content_type") or media_type_padrao
+    headers["Accept-Ranges"] = "bytes"
+    # Só raster e PDF são exibidos inline; qualquer outro tipo (arquivos
+    # antigos com content_type do cliente) vira download
+    if media_type.split(";")[0].strip().lower() not in TIPOS_SERVIDOS_INLINE:
+        headers.setdefault("Content-Disposition", "attachment")
+    
+    intervalo = None
+    range_header = request.headers.get("range")
+    if range_header:
+        intervalo = _intervalo_range(range_header, tamanho)
+    
+    if intervalo:
+        inicio, fim = intervalo
+        headers["Content-Range"] = f"bytes {inicio}-{fim}/{tamanho}"
+        headers["Content-Length"] = str(fim - inicio + 1)
+        return StreamingResponse(
+            _ler_gridfs(grid_out, inicio, fim - inicio + 1),
+            status_code=206,
+            media_type=media_type,
+            headers=headers
+        )
+    
+    headers["Content-Length"] = str(tamanho)
+    return StreamingResponse(
+        _ler_gridfs(grid_out, 0, tamanho),
+        media_type=media_type,
+        headers=headers
+    )
+
 # Planta Routes
 @api_router.post("/plantas")
 async def upload_planta(
@@ -634,19 +1640,14 @@ async def upload_planta(
     if not empresa:
         raise HTTPException(status_code=404, detail="Empresa not found")
     
-    file_content = await file.read()
-    file_id = await fs.upload_from_stream(
-        file.filename,
-        io.BytesIO(file_content),
-        metadata={"content_type": file.content_type}
-    )
+    file_id = await salvar_upload_gridfs(file, "planta")
     
     planta_id = f"plt_{uuid.uuid4().hex[:12]}"
     planta_dict = {
         "planta_id": planta_id,
         "empresa_id": empresa_id,
         "nome": nome,
-        "arquivo_id": str(file_id),
+        "arquivo_id": file_id,
         "tipo_arquivo": file.content_type,
         "status": "aguardando_marcacao",
         "created_at": datetime.now(timezone.utc)
@@ -671,7 +1672,7 @@ async def upload_planta(
     await db.tickets.insert_one(ticket_dict)
     
     # Enviar email para gestor
-    await enviar_email_notificacao(
+    enviar_email_notificacao(
         GESTORES_EMAILS[0],
         "Novo Ticket - EcoGuard",
         f"Nova planta enviada por {user.email}. Ticket #{ticket_id[-8:]}. Acesse o sistema para mapear as áreas críticas."
@@ -710,13 +1711,12 @@ async def get_planta_file(planta_id: str, request: Request):
     if not planta:
         raise HTTPException(status_code=404, detail="Planta not found")
     
-    from bson import ObjectId
-    file_stream = await fs.open_download_stream(ObjectId(planta["arquivo_id"]))
-    file_content = await file_stream.read()
-    
-    return Response(
-        content=file_content,
-        media_type=planta["tipo_arquivo"]
+    return await servir_arquivo_gridfs(
+        planta["arquivo_id"],
+        request,
+        media_type_padrao=planta["tipo_arquivo"],
+        nao_encontrado="Planta not found",
+        imutavel=True
     )
 
 @api_router.put("/plantas/{planta_id}")
@@ -763,9 +1763,10 @@ async def get_areas(planta_id: str, request: Request):
 @api_router.delete("/areas/{area_id}")
 async def delete_area(area_id: str, request: Request):
     user = await get_current_user(request)
-    result = await db.areas_criticas.delete_one({"area_id": area_id})
-    if result.deleted_count == 0:
+    area = await db.areas_criticas.find_one_and_delete({"area_id": area_id}, {"_id": 0, "foto_cliente_id": 1})
+    if area is None:
         raise HTTPException(status_code=404, detail="Area not found")
+    await liberar_blob(area.get("foto_cliente_id"))
     return {"message": "Area deleted"}
 
 # Checklist Routes
@@ -780,38 +1781,43 @@ async def get_checklist_items(tipo_area: str, request: Request):
 async def create_inspecao(empresa_id: str, planta_id: str, request: Request):
     user = await get_current_user(request)
     
-    areas = await db.areas_criticas.find({"planta_id": planta_id}, {"_id": 0}).to_list(100)
+    areas = await db.areas_criticas.find(
+        {"planta_id": planta_id},
+        {"_id": 0, "area_id": 1, "tipo_area": 1}
+    ).to_list(None)
     
     if not areas:
         raise HTTPException(status_code=400, detail="No areas found for this planta")
     
     inspecao_id = f"insp_{uuid.uuid4().hex[:12]}"
     
-    total_itens = 0
-    ordem = 0
+    # Uma única consulta para o checklist de todos os tipos de área da planta
+    tipos_area = list({area["tipo_area"] for area in areas})
+    checklist_por_tipo: Dict[str, List[str]] = {tipo: [] for tipo in tipos_area}
+    async for item in db.checklist_items.find(
+        {"tipo_area": {"$in": tipos_area}},
+        {"_id": 0, "item_id": 1, "tipo_area": 1}
+    ).sort([("tipo_area", 1), ("ordem", 1)]):
+        checklist_por_tipo[item["tipo_area"]].append(item["item_id"])
     
+    itens = []
     for area in areas:
-        checklist_items = await db.checklist_items.find(
-            {"tipo_area": area["tipo_area"]},
-            {"_id": 0}
-        ).to_list(100)
-        
-        for item in checklist_items:
-            item_inspecao_id = f"itinsp_{uuid.uuid4().hex[:12]}"
-            await db.inspecao_itens.insert_one({
-                "item_inspecao_id": item_inspecao_id,
+        for checklist_item_id in checklist_por_tipo[area["tipo_area"]]:
+            itens.append({
+                "item_inspecao_id": f"itinsp_{uuid.uuid4().hex[:12]}",
                 "inspecao_id": inspecao_id,
                 "area_critica_id": area["area_id"],
-                "checklist_item_id": item["item_id"],
+                "checklist_item_id": checklist_item_id,
                 "resposta": None,
                 "foto_id": None,
                 "observacao": None,
                 "risco_detectado": False,
                 "data_resposta": None,
-                "ordem": ordem
+                "ordem": len(itens)
             })
-            total_itens += 1
-            ordem += 1
+    
+    if itens:
+        await db.inspecao_itens.insert_many(itens, ordered=True)
     
     inspecao_dict = {
         "inspecao_id": inspecao_id,
@@ -821,7 +1827,7 @@ async def create_inspecao(empresa_id: str, planta_id: str, request: Request):
         "status": "em_andamento",
         "score_final": None,
         "nivel_risco": None,
-        "total_itens": total_itens,
+        "total_itens": len(itens),
         "itens_conformes": 0,
         "itens_nao_conformes": 0,
         "created_at": datetime.now(timezone.utc),
@@ -829,8 +1835,7 @@ async def create_inspecao(empresa_id: str, planta_id: str, request: Request):
     }
     
     await db.auto_inspecoes.insert_one(inspecao_dict)
-    inspecao_doc = await db.auto_inspecoes.find_one({"inspecao_id": inspecao_id}, {"_id": 0})
-    return AutoInspecao(**inspecao_doc)
+    return AutoInspecao(**inspecao_dict)
 
 @api_router.get("/inspecoes/{inspecao_id}", response_model=AutoInspecao)
 async def get_inspecao(inspecao_id: str, request: Request):
@@ -849,23 +1854,24 @@ async def get_inspecao_items(inspecao_id: str, request: Request):
         {"_id": 0}
     ).sort("ordem", 1).to_list(1000)
     
-    result = []
-    for item in items:
-        area = await db.areas_criticas.find_one(
-            {"area_id": item["area_critica_id"]},
-            {"_id": 0}
-        )
-        checklist_item = await db.checklist_items.find_one(
-            {"item_id": item["checklist_item_id"]},
-            {"_id": 0}
-        )
-        result.append({
-            **item,
-            "area": area,
-            "checklist_item": checklist_item
-        })
+    # Áreas e itens de checklist em duas consultas $in, juntados em memória
+    area_ids = list({item["area_critica_id"] for item in items})
+    checklist_ids = list({item["checklist_item_id"] for item in items})
+    areas, checklist_items = await asyncio.gather(
+        db.areas_criticas.find({"area_id": {"$in": area_ids}}, {"_id": 0}).to_list(None),
+        db.checklist_items.find({"item_id": {"$in": checklist_ids}}, {"_id": 0}).to_list(None)
+    )
+    areas_por_id = {area["area_id"]: area for area in areas}
+    checklist_por_id = {c["item_id"]: c for c in checklist_items}
     
-    return result
+    return [
+        {
+            **item,
+            "area": areas_por_id.get(item["area_critica_id"]),
+            "checklist_item": checklist_por_id.get(item["checklist_item_id"])
+        }
+        for item in items
+    ]
 
 @api_router.put("/inspecoes/{inspecao_id}/items/{item_inspecao_id}")
 async def update_inspecao_item(
@@ -880,17 +1886,11 @@ async def update_inspecao_item(
     
     foto_id = None
     if foto:
-        file_content = await foto.read()
-        file_id = await fs.upload_from_stream(
-            foto.filename,
-            io.BytesIO(file_content),
-            metadata={"content_type": foto.content_type}
-        )
-        foto_id = str(file_id)
+        foto_id = await salvar_upload_gridfs(foto, "foto")
     
     risco_detectado = resposta == "nao_conforme"
     
-    await db.inspecao_itens.update_one(
+    anterior = await db.inspecao_itens.find_one_and_update(
         {"item_inspecao_id": item_inspecao_id, "inspecao_id": inspecao_id},
         {"$set": {
             "resposta": resposta,
@@ -898,14 +1898,30 @@ async def update_inspecao_item(
             "observacao": observacao,
             "risco_detectado": risco_detectado,
             "data_resposta": datetime.now(timezone.utc)
-        }}
+        }},
+        projection={"_id": 0, "foto_id": 1}
     )
+    if anterior is None or anterior.get("foto_id") == foto_id:
+        # Item inexistente ou o mesmo blob reenviado: a referência nova sobra
+        await liberar_blob(foto_id)
+        if anterior is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+    else:
+        await liberar_blob(anterior.get("foto_id"))
+        if foto_id:
+            em_background(gerar_derivados(foto_id))
     
     item_doc = await db.inspecao_itens.find_one({"item_inspecao_id": item_inspecao_id}, {"_id": 0})
     return item_doc
 
 @api_router.get("/inspecoes/{inspecao_id}/items/{item_inspecao_id}/foto")
-async def get_item_foto(inspecao_id: str, item_inspecao_id: str, request: Request):
+async def get_item_foto(
+    inspecao_id: str,
+    item_inspecao_id: str,
+    request: Request,
+    size: Optional[int] = None,
+    v: Optional[str] = None
+):
     user = await get_current_user(request)
     item = await db.inspecao_itens.find_one(
         {"item_inspecao_id": item_inspecao_id, "inspecao_id": inspecao_id},
@@ -915,21 +1931,46 @@ async def get_item_foto(inspecao_id: str, item_inspecao_id: str, request: Reques
     if not item or not item.get("foto_id"):
         raise HTTPException(status_code=404, detail="Foto not found")
     
-    from bson import ObjectId
-    file_stream = await fs.open_download_stream(ObjectId(item["foto_id"]))
-    file_content = await file_stream.read()
-    
-    return Response(content=file_content, media_type="image/jpeg")
+    return await servir_arquivo_gridfs(
+        await arquivo_para_tamanho(item["foto_id"], size),
+        request,
+        media_type_padrao="image/jpeg",
+        nao_encontrado="Foto not found",
+        imutavel=v == item["foto_id"]
+    )
 
-@api_router.post("/inspecoes/{inspecao_id}/complete")
-async def complete_inspecao(inspecao_id: str, request: Request):
-    user = await get_current_user(request)
-    
-    items = await db.inspecao_itens.find({"inspecao_id": inspecao_id}, {"_id": 0}).to_list(1000)
+_suporta_transacoes: Optional[bool] = None
+
+async def suporta_transacoes() -> bool:
+    """Transações exigem replica set ou mongos; o resultado é memorizado"""
+    global _suporta_transacoes
+    if _suporta_transacoes is None:
+        try:
+            hello = await client.admin.command("hello")
+            _suporta_transacoes = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+        except Exception as e:
+            logger.warning(f"Não foi possível verificar suporte a transações: {e}")
+            _suporta_transacoes = False
+    return _suporta_transacoes
+
+async def _concluir_inspecao(inspecao_id: str, session=None):
+    # Contagem por resposta e itens não conformes em uma única agregação
+    resultado = await db.inspecao_itens.aggregate([
+        {"$match": {"inspecao_id": inspecao_id}},
+        {"$facet": {
+            "contagem": [{"$group": {"_id": "$resposta", "total": {"$sum": 1}}}],
+            "nao_conformes": [
+                {"$match": {"resposta": "nao_conforme"}},
+                {"$project": {"_id": 0, "item_inspecao_id": 1, "area_critica_id": 1, "checklist_item_id": 1}}
+            ]
+        }}
+    ], session=session).to_list(1)
+    contagem = {c["_id"]: c["total"] for c in resultado[0]["contagem"]}
+    nao_conformes_items = resultado[0]["nao_conformes"]
     
-    total = len(items)
-    conformes = len([i for i in items if i.get("resposta") == "conforme"])
-    nao_conformes = len([i for i in items if i.get("resposta") == "nao_conforme"])
+    total = sum(contagem.values())
+    conformes = contagem.get("conforme", 0)
+    nao_conformes = contagem.get("nao_conforme", 0)
     
     score = (conformes / total * 100) if total > 0 else 0
     
@@ -949,39 +1990,143 @@ async def complete_inspecao(inspecao_id: str, request: Request):
             "score_final": round(score, 2),
             "nivel_risco": nivel_risco,
             "itens_conformes": conformes,
-            "itens_nao_conformes": nao_conformes,
-            "completed_at": datetime.now(timezone.utc)
-        }}
+            "itens_nao_conformes": nao_conformes
+        }},
+        session=session
+    )
+    # completed_at registra a primeira conclusão: concluir de novo devolve o mesmo resultado
+    await db.auto_inspecoes.update_one(
+        {"inspecao_id": inspecao_id, "completed_at": None},
+        {"$set": {"completed_at": datetime.now(timezone.utc)}},
+        session=session
     )
     
-    # Criar alertas para itens não conformes
-    nao_conformes_items = [i for i in items if i.get("resposta") == "nao_conforme"]
+    if not nao_conformes_items:
+        return
+    
+    # Criar alertas para itens não conformes (upsert por item: concluir de novo não duplica)
+    checklist_ids = list({item["checklist_item_id"] for item in nao_conformes_items})
+    checklist_por_id = {
+        c["item_id"]: c
+        for c in await db.checklist_items.find(
+            {"item_id": {"$in": checklist_ids}},
+            {"_id": 0},
+            session=session
+        ).to_list(None)
+    }
     
+    operacoes = []
     for item in nao_conformes_items:
-        checklist_item = await db.checklist_items.find_one(
-            {"item_id": item["checklist_item_id"]},
-            {"_id": 0}
-        )
+        checklist_item = checklist_por_id.get(item["checklist_item_id"])
+        if not checklist_item:
+            continue
         
-        if checklist_item:
-            alerta_id = f"alert_{uuid.uuid4().hex[:12]}"
-            multa_estimada = checklist_item.get("pontos_risco", 10) * 5000
-            
-            await db.alertas.insert_one({
-                "alerta_id": alerta_id,
-                "inspecao_id": inspecao_id,
+        operacoes.append(UpdateOne(
+            {"inspecao_id": inspecao_id, "item_inspecao_id": item["item_inspecao_id"]},
+            {"$setOnInsert": {
+                "alerta_id": f"alert_{uuid.uuid4().hex[:12]}",
                 "area_critica_id": item["area_critica_id"],
                 "tipo_alerta": checklist_item["categoria"],
                 "descricao": checklist_item["pergunta"],
                 "gravidade": checklist_item["criticidade"],
-                "valor_multa_estimado": multa_estimada,
+                "valor_multa_estimado": checklist_item.get("pontos_risco", 10) * 5000,
                 "status": "pendente",
                 "prazo_sugerido_dias": 30 if checklist_item["criticidade"] == "alta" else 60,
                 "created_at": datetime.now(timezone.utc)
-            })
+            }},
+            upsert=True
+        ))
     
-    inspecao_doc = await db.auto_inspecoes.find_one({"inspecao_id": inspecao_id}, {"_id": 0})
-    return AutoInspecao(**inspecao_doc)
+    if operacoes:
+        await db.alertas.bulk_write(operacoes, ordered=False, session=session)
+
+@api_router.post("/inspecoes/{inspecao_id}/complete")
+async def complete_inspecao(inspecao_id: str, request: Request):
+    user = await get_current_user(request)
+    
+    try:
+        if await suporta_transacoes():
+            # with_transaction repete em TransientTransactionError / conflito de escrita
+            async with await client.start_session() as session:
+                await session.with_transaction(
+                    lambda s: _concluir_inspecao(inspecao_id, session=s)
+                )
+        else:
+            # Mongo standalone: sem transação, mas a conclusão é idempotente
+            await _concluir_inspecao(inspecao_id)
+    except (DuplicateKeyError, BulkWriteError) as e:
+        # Duas conclusões simultâneas criando o mesmo alerta: a outra venceu e
+        # já gravou o resultado, que é relido abaixo
+        if isinstance(e, BulkWriteError) and any(
+            erro.get("code") != 11000 for erro in e.details.get("writeErrors", [])
+        ):
+            raise
+        logger.info(f"Inspeção {inspecao_id} concluída em paralelo; relendo o resultado")
+    
+    inspecao_doc = await db.auto_inspecoes.find_one({"inspecao_id": inspecao_id}, {"_id": 0})
+    return AutoInspecao(**inspecao_doc)
+
+# Status materializado das licenças
+# status (valida / a_vencer / vencida) é gravado na escrita e mantido por um
+# job diário à meia-noite (UTC), que só toca as licenças que cruzaram um limite.
+STATUS_LICENCA = ("valida", "a_vencer", "vencida")
+
+def calcular_status_licenca(data_validade, dias_alerta: int, agora: datetime) -> str:
+    if isinstance(data_validade, str):
+        data_validade = datetime.fromisoformat(data_validade)
+    if data_validade.tzinfo is None:
+        data_validade = data_validade.replace(tzinfo=timezone.utc)
+    dias_restantes = (data_validade - agora).days
+    if dias_restantes < 0:
+        return "vencida"
+    if dias_restantes <= dias_alerta:
+        return "a_vencer"
+    return "valida"
+
+async def atualizar_status_licencas() -> int:
+    """Grava o status das licenças cujo status materializado ficou desatualizado"""
+    agora = datetime.now(timezone.utc)
+    # Candidatas: já venceram sem estar vencidas, entraram na maior janela de
+    # alerta possível ainda como válidas, a vencer que saíram da própria janela
+    # (validade renovada ou antecedência reduzida) ou sem status reconhecido
+    fim_janela = {"$add": [agora, {"$multiply": [{"$add": [{"$ifNull": ["$dias_alerta_vencimento", 30]}, 1]}, 86400000]}]}
+    candidatas = db.licencas_documentos.find(
+        {"$or": [
+            {"status": {"$in": ["valida", "a_vencer"]}, "data_validade": {"$lt": agora}},
+            {"status": "valida", "data_validade": {"$lte": agora + timedelta(days=ALERTA_HORIZONTE_MAXIMO_DIAS + 1)}},
+            {"status": "a_vencer", "$expr": {"$gte": ["$data_validade", fim_janela]}},
+            {"status": {"$nin": list(STATUS_LICENCA)}, "data_validade": {"$ne": None}},
+        ]},
+        {"_id": 0, "licenca_id": 1, "status": 1, "data_validade": 1, "dias_alerta_vencimento": 1}
+    )
+    operacoes = []
+    total = 0
+    async for licenca in candidatas:
+        status = calcular_status_licenca(licenca["data_validade"], licenca.get("dias_alerta_vencimento", 30), agora)
+        if status != licenca.get("status"):
+            operacoes.append(UpdateOne({"licenca_id": licenca["licenca_id"]}, {"$set": {"status": status}}))
+        if len(operacoes) >= 1000:
+            await db.licencas_documentos.bulk_write(operacoes, ordered=False)
+            total += len(operacoes)
+            operacoes = []
+    if operacoes:
+        await db.licencas_documentos.bulk_write(operacoes, ordered=False)
+        total += len(operacoes)
+    if total:
+        logger.info(f"🗓️  Status atualizado em {total} licenças")
+    return total
+
+async def job_status_licencas():
+    """Roda na inicialização e depois a cada meia-noite UTC, sob lease"""
+    while True:
+        try:
+            await lease_status_licencas.executar(atualizar_status_licencas)
+        except Exception as e:
+            logger.error(f"Erro ao atualizar status das licenças: {e}")
+        agora = datetime.now(timezone.utc)
+        amanha = agora.date() + timedelta(days=1)
+        meia_noite = datetime(amanha.year, amanha.month, amanha.day, tzinfo=timezone.utc)
+        await asyncio.sleep((meia_noite - agora).total_seconds() + 1)
 
 # Dashboard Routes
 @api_router.get("/dashboard/{empresa_id}")
@@ -1002,30 +2147,12 @@ async def get_dashboard(empresa_id: str, request: Request):
             {"_id": 0}
         ).sort("gravidade", -1).to_list(100)
     
+    # status é materializado na escrita e pelo job diário (atualizar_status_licencas)
     licencas = await db.licencas_documentos.find(
         {"empresa_id": empresa_id},
         {"_id": 0}
     ).to_list(100)
     
-    for licenca in licencas:
-        if licenca.get("data_validade"):
-            if isinstance(licenca["data_validade"], str):
-                data_validade = datetime.fromisoformat(licenca["data_validade"])
-            else:
-                data_validade = licenca["data_validade"]
-            
-            if data_validade.tzinfo is None:
-                data_validade = data_validade.replace(tzinfo=timezone.utc)
-            
-            dias_restantes = (data_validade - datetime.now(timezone.utc)).days
-            
-            if dias_restantes < 0:
-                licenca["status"] = "vencida"
-            elif dias_restantes <= 30:
-                licenca["status"] = "vencendo_30dias"
-            else:
-                licenca["status"] = "valida"
-    
     return {
         "ultima_inspecao": ultima_inspecao,
         "inspecoes_historico": inspecoes,
@@ -1048,14 +2175,7 @@ async def create_licenca(licenca_data: LicencaDocumentoCreate, request: Request)
     if data_validade.tzinfo is None:
         data_validade = data_validade.replace(tzinfo=timezone.utc)
     
-    dias_restantes = (data_validade - datetime.now(timezone.utc)).days
-    
-    if dias_restantes < 0:
-        status = "vencida"
-    elif dias_restantes <= licenca_data.dias_alerta_vencimento:
-        status = "a_vencer"
-    else:
-        status = "valida"
+    status = calcular_status_licenca(data_validade, licenca_data.dias_alerta_vencimento, datetime.now(timezone.utc))
     
     licenca_dict = {
         "licenca_id": licenca_id,
@@ -1073,8 +2193,10 @@ async def create_licenca(licenca_data: LicencaDocumentoCreate, request: Request)
         "created_at": datetime.now(timezone.utc),
         "updated_at": datetime.now(timezone.utc)
     }
+    licenca_dict["next_alert_at"] = proximo_alerta_licenca(licenca_dict, datetime.now(timezone.utc))
     
     await db.licencas_documentos.insert_one(licenca_dict)
+    agenda_alertas.agendar(("licenca", licenca_id), licenca_dict["next_alert_at"])
     licenca_doc = await db.licencas_documentos.find_one({"licenca_id": licenca_id}, {"_id": 0})
     return LicencaDocumento(**licenca_doc)
 
@@ -1095,24 +2217,6 @@ async def get_licencas(
         query["tipo"] = tipo
     
     licencas = await db.licencas_documentos.find(query, {"_id": 0}).to_list(1000)
-    
-    for licenca in licencas:
-        if licenca.get("data_validade"):
-            data_validade = licenca["data_validade"]
-            if isinstance(data_validade, str):
-                data_validade = datetime.fromisoformat(data_validade)
-            if data_validade.tzinfo is None:
-                data_validade = data_validade.replace(tzinfo=timezone.utc)
-            
-            dias_restantes = (data_validade - datetime.now(timezone.utc)).days
-            
-            if dias_restantes < 0:
-                licenca["status"] = "vencida"
-            elif dias_restantes <= licenca.get("dias_alerta_vencimento", 30):
-                licenca["status"] = "a_vencer"
-            else:
-                licenca["status"] = "valida"
-    
     return licencas
 
 @api_router.get("/licencas/{licenca_id}", response_model=LicencaDocumento)
@@ -1141,6 +2245,8 @@ async def update_licenca(licenca_id: str, licenca_data: LicencaDocumentoUpdate,
     )
     
     licenca_doc = await db.licencas_documentos.find_one({"licenca_id": licenca_id}, {"_id": 0})
+    if licenca_doc and ("data_validade" in update_dict or "dias_alerta_vencimento" in update_dict):
+        licenca_doc.update(await recalcular_licenca(licenca_doc))
     return LicencaDocumento(**licenca_doc)
 
 @api_router.delete("/licencas/{licenca_id}")
@@ -1152,6 +2258,7 @@ async def delete_licenca(licenca_id: str, request: Request):
     result = await db.licencas_documentos.delete_one({"licenca_id": licenca_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Licença not found")
+    agenda_alertas.remover(("licenca", licenca_id))
     return {"message": "Licença deleted"}
 
 # Condicionantes Routes
@@ -1172,8 +2279,10 @@ async def create_condicionante(licenca_id: str, condicionante_data: Condicionant
     
     condicionante_dict["data_acompanhamento"] = datetime.fromisoformat(condicionante_dict["data_acompanhamento"])
     condicionante_dict["alerta_acompanhamento"] = datetime.fromisoformat(condicionante_dict["alerta_acompanhamento"])
+    condicionante_dict["next_alert_at"] = proximo_alerta_condicionante(condicionante_dict, datetime.now(timezone.utc))
     
     await db.condicionantes.insert_one(condicionante_dict)
+    agenda_alertas.agendar(("condicionante", condicionante_id), condicionante_dict["next_alert_at"])
     condicionante_doc = await db.condicionantes.find_one({"condicionante_id": condicionante_id}, {"_id": 0})
     return Condicionante(**condicionante_doc)
 
@@ -1221,6 +2330,8 @@ async def update_condicionante(condicionante_id: str, condicionante_data: Condic
     )
     
     condicionante_doc = await db.condicionantes.find_one({"condicionante_id": condicionante_id}, {"_id": 0})
+    if condicionante_doc and "data_acompanhamento" in update_dict:
+        await reagendar_condicionante(condicionante_doc)
     return Condicionante(**condicionante_doc)
 
 @api_router.delete("/condicionantes/{condicionante_id}")
@@ -1229,71 +2340,83 @@ async def delete_condicionante(condicionante_id: str, request: Request):
     result = await db.condicionantes.delete_one({"condicionante_id": condicionante_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Condicionante not found")
+    agenda_alertas.remover(("condicionante", condicionante_id))
     return {"message": "Condicionante deleted"}
 
 # Indicadores/Dashboard de Licenças
 @api_router.get("/licencas/indicadores/dashboard")
-async def get_licencas_dashboard(request: Request, empresa_id: Optional[str] = None):
+async def get_licencas_dashboard(
+    request: Request,
+    empresa_id: Optional[str] = None,
+    incluir_licencas: bool = False,
+    skip: int = 0,
+    limit: int = 50
+):
+    """Indicadores calculados no Mongo em um único $facet; a lista completa é opcional e paginada.
+
+    A página da lista é uma consulta própria, ordenada pelo índice
+    (empresa_id, data_validade, licenca_id): dentro do $facet a ordenação não
+    usaria índice e todo o conjunto passaria pela memória.
+    """
     user = await get_current_user(request)
     
     query = {}
     if empresa_id:
         query["empresa_id"] = empresa_id
     
-    licencas = await db.licencas_documentos.find(query, {"_id": 0}).to_list(1000)
+    agora = datetime.now(timezone.utc)
+    facetas = {
+        "total": [{"$count": "n"}],
+        "por_status": [
+            {"$match": {"data_validade": {"$ne": None}}},
+            {"$group": {"_id": "$status", "n": {"$sum": 1}}}
+        ],
+        "por_tipo": [
+            {"$group": {"_id": {"$ifNull": ["$tipo", "Outros"]}, "n": {"$sum": 1}}}
+        ],
+        "proximos_vencimentos": [
+            {"$match": {"data_validade": {"$gte": agora, "$lt": agora + timedelta(days=ALERTA_HORIZONTE_MAXIMO_DIAS + 1)}}},
+            {"$sort": {"data_validade": 1, "licenca_id": 1}},
+            {"$limit": 10},
+            {"$project": {"_id": 0, "licenca_id": 1, "nome_licenca": 1, "empresa_id": 1, "data_validade": 1}}
+        ]
+    }
+    indicadores = db.licencas_documentos.aggregate([
+        {"$match": query},
+        {"$facet": facetas}
+    ]).to_list(1)
+    if incluir_licencas:
+        limite = min(max(limit, 1), 500)
+        pagina = db.licencas_documentos.find(query, {"_id": 0}).sort(
+            [("data_validade", 1), ("licenca_id", 1)]
+        ).skip(max(skip, 0)).limit(limite).to_list(limite)
+        resultado, licencas = await asyncio.gather(indicadores, pagina)
+    else:
+        resultado = await indicadores
+    resultado = resultado[0] if resultado else {}
     
-    total = len(licencas)
-    validas = 0
-    a_vencer = 0
-    vencidas = 0
+    por_status = {s["_id"]: s["n"] for s in resultado.get("por_status", [])}
     
     proximos_vencimentos = []
+    for licenca in resultado.get("proximos_vencimentos", []):
+        data_validade = _como_utc(licenca["data_validade"])
+        proximos_vencimentos.append({
+            **licenca,
+            "data_validade": data_validade.isoformat(),
+            "dias_restantes": (data_validade - agora).days
+        })
     
-    for licenca in licencas:
-        data_validade = licenca.get("data_validade")
-        if data_validade:
-            if isinstance(data_validade, str):
-                data_validade = datetime.fromisoformat(data_validade)
-            if data_validade.tzinfo is None:
-                data_validade = data_validade.replace(tzinfo=timezone.utc)
-            
-            dias_restantes = (data_validade - datetime.now(timezone.utc)).days
-            
-            if dias_restantes < 0:
-                vencidas += 1
-                licenca["status"] = "vencida"
-            elif dias_restantes <= 180:
-                a_vencer += 1
-                licenca["status"] = "a_vencer"
-                proximos_vencimentos.append({
-                    "licenca_id": licenca["licenca_id"],
-                    "nome_licenca": licenca["nome_licenca"],
-                    "empresa_id": licenca["empresa_id"],
-                    "data_validade": data_validade.isoformat(),
-                    "dias_restantes": dias_restantes
-                })
-            else:
-                validas += 1
-                licenca["status"] = "valida"
-    
-    proximos_vencimentos.sort(key=lambda x: x["dias_restantes"])
-    
-    por_tipo = {}
-    for licenca in licencas:
-        tipo = licenca.get("tipo", "Outros")
-        if tipo not in por_tipo:
-            por_tipo[tipo] = 0
-        por_tipo[tipo] += 1
-    
-    return {
-        "total": total,
-        "validas": validas,
-        "a_vencer": a_vencer,
-        "vencidas": vencidas,
-        "proximos_vencimentos": proximos_vencimentos[:10],
-        "por_tipo": por_tipo,
-        "licencas": licencas
+    dashboard = {
+        "total": resultado["total"][0]["n"] if resultado.get("total") else 0,
+        "validas": por_status.get("valida", 0),
+        "a_vencer": por_status.get("a_vencer", 0),
+        "vencidas": por_status.get("vencida", 0),
+        "proximos_vencimentos": proximos_vencimentos,
+        "por_tipo": {t["_id"]: t["n"] for t in resultado.get("por_tipo", [])}
     }
+    if incluir_licencas:
+        dashboard["licencas"] = licencas
+    return dashboard
 
 @api_router.get("/licencas/{empresa_id}", response_model=List[LicencaDocumento])
 async def get_licencas_old(empresa_id: str, request: Request):
@@ -1324,8 +2447,14 @@ async def create_licenca_old(
         licenca_dict["data_emissao"] = datetime.fromisoformat(licenca_dict["data_emissao"])
     if licenca_dict.get("data_validade"):
         licenca_dict["data_validade"] = datetime.fromisoformat(licenca_dict["data_validade"])
+    if licenca_dict.get("data_validade"):
+        licenca_dict["status"] = calcular_status_licenca(
+            licenca_dict["data_validade"], licenca_dict.get("dias_alerta_vencimento", 30), datetime.now(timezone.utc)
+        )
+    licenca_dict["next_alert_at"] = proximo_alerta_licenca(licenca_dict, datetime.now(timezone.utc))
     
     await db.licencas_documentos.insert_one(licenca_dict)
+    agenda_alertas.agendar(("licenca", licenca_id), licenca_dict["next_alert_at"])
     licenca_doc = await db.licencas_documentos.find_one({"licenca_id": licenca_id}, {"_id": 0})
     return LicencaDocumento(**licenca_doc)
 
@@ -1346,26 +2475,74 @@ async def update_alerta_status(alerta_id: str, status: str, request: Request):
     return alerta_doc
 
 # Tickets Routes
+def _codificar_cursor_ticket(ticket: dict) -> str:
+    created_at = ticket["created_at"]
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    return _b64url_encode(json.dumps([created_at, ticket["ticket_id"]]).encode())
+
+def _decodificar_cursor_ticket(cursor: str) -> tuple:
+    try:
+        created_at, ticket_id = json.loads(_b64url_decode(cursor))
+        return datetime.fromisoformat(created_at), ticket_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
 @api_router.get("/tickets")
-async def get_tickets(request: Request):
+async def get_tickets(
+    request: Request,
+    response: Response,
+    status: Optional[str] = None,
+    etapa: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 1000
+):
+    """Lista tickets do mais recente para o mais antigo.
+
+    Paginação por keyset em (created_at, ticket_id): quando há mais páginas,
+    o cursor da próxima vem no header X-Next-Cursor.
+    """
     user = await get_current_user(request)
+    limit = max(1, min(limit, 1000))
     
-    if is_gestor(user):
-        # Gestor vê todos os tickets (incluindo excluídos pelo cliente)
-        tickets = await db.tickets.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    else:
+    # Gestor vê todos os tickets (incluindo excluídos pelo cliente)
+    filtros = []
+    if not is_gestor(user):
         # Cliente vê apenas seus tickets que não foram excluídos
-        tickets = await db.tickets.find({
-            "user_id": user.user_id,
-            "$or": [{"deleted_by_client": {"$exists": False}}, {"deleted_by_client": False}]
-        }, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    
-    # Enriquecer com dados da empresa e planta
+        filtros.append({"user_id": user.user_id})
+        filtros.append({"$or": [{"deleted_by_client": {"$exists": False}}, {"deleted_by_client": False}]})
+    if status:
+        filtros.append({"status": status})
+    if etapa:
+        filtros.append({"etapa": etapa})
+    if cursor:
+        cursor_created_at, cursor_ticket_id = _decodificar_cursor_ticket(cursor)
+        filtros.append({"$or": [
+            {"created_at": {"$lt": cursor_created_at}},
+            {"created_at": cursor_created_at, "ticket_id": {"$lt": cursor_ticket_id}}
+        ]})
+    
+    query = {"$and": filtros} if filtros else {}
+    tickets = await db.tickets.find(query, {"_id": 0}).sort(
+        [("created_at", -1), ("ticket_id", -1)]
+    ).limit(limit + 1).to_list(None)
+    
+    if len(tickets) > limit:
+        tickets = tickets[:limit]
+        response.headers["X-Next-Cursor"] = _codificar_cursor_ticket(tickets[-1])
+    
+    # Enriquecer com dados da empresa e planta (duas consultas $in)
+    empresa_ids = list({t["empresa_id"] for t in tickets})
+    planta_ids = list({t["planta_id"] for t in tickets})
+    empresas, plantas = await asyncio.gather(
+        db.empresas.find({"empresa_id": {"$in": empresa_ids}}, {"_id": 0}).to_list(None),
+        db.plantas_estabelecimento.find({"planta_id": {"$in": planta_ids}}, {"_id": 0}).to_list(None)
+    )
+    empresas_por_id = {e["empresa_id"]: e for e in empresas}
+    plantas_por_id = {p["planta_id"]: p for p in plantas}
     for ticket in tickets:
-        empresa = await db.empresas.find_one({"empresa_id": ticket["empresa_id"]}, {"_id": 0})
-        planta = await db.plantas_estabelecimento.find_one({"planta_id": ticket["planta_id"]}, {"_id": 0})
-        ticket["empresa"] = empresa
-        ticket["planta"] = planta
+        ticket["empresa"] = empresas_por_id.get(ticket["empresa_id"])
+        ticket["planta"] = plantas_por_id.get(ticket["planta_id"])
     
     return tickets
 
@@ -1429,7 +2606,7 @@ async def add_ticket_mensagem(ticket_id: str, mensagem: str, tipo: str, request:
         if is_gestor(user):
             cliente_email = ticket.get("user_email")
             if cliente_email:
-                await enviar_email_notificacao(
+                enviar_email_notificacao(
                     cliente_email,
                     f"Nova mensagem no Ticket #{ticket_id[-8:]} - EcoGuard",
                     f"O gestor enviou uma nova mensagem no seu ticket:<br><br><em>\"{mensagem}\"</em><br><br>Acesse o sistema para mais detalhes."
@@ -1437,13 +2614,13 @@ async def add_ticket_mensagem(ticket_id: str, mensagem: str, tipo: str, request:
         # Se mensagem do cliente, notificar gestor e admin
         else:
             # Notificar gestor
-            await enviar_email_notificacao(
+            enviar_email_notificacao(
                 GESTORES_EMAILS[0],
                 f"Nova mensagem no Ticket #{ticket_id[-8:]} - EcoGuard",
                 f"O cliente {user.email} enviou uma mensagem no ticket:<br><br><em>\"{mensagem}\"</em><br><br>Acesse o sistema para responder."
             )
             # Notificar admin
-            await enviar_email_notificacao(
+            enviar_email_notificacao(
                 ADMIN_EMAIL,
                 f"Alerta: Nova mensagem - Ticket #{ticket_id[-8:]}",
                 f"Cliente: {user.email}<br>Mensagem: <em>\"{mensagem}\"</em><br><br>Ticket ID: {ticket_id}"
@@ -1497,44 +2674,47 @@ async def update_ticket_status(ticket_id: str, status: str, etapa: str, request:
         "created_at": datetime.now(timezone.utc)
     })
     
+    if etapa == "finalizado":
+        em_background(pre_renderizar_relatorio(ticket_id))
+    
     # Enviar emails de notificação
     cliente_email = ticket["user_email"]
     
     if etapa == "upload_fotos_cliente":
         # Gestor mapeou áreas, notificar cliente
-        await enviar_email_notificacao(
+        enviar_email_notificacao(
             cliente_email,
             f"Atualização Ticket #{ticket_id[-8:]} - EcoGuard",
             f"Seu ticket foi atualizado. As áreas críticas foram mapeadas. Acesse o sistema para enviar as fotos solicitadas."
         )
         # Notificar admin
-        await enviar_email_notificacao(
+        enviar_email_notificacao(
             ADMIN_EMAIL,
             f"Alerta: Ticket #{ticket_id[-8:]} - Áreas mapeadas",
             f"Cliente: {cliente_email}<br>Status: Aguardando upload de fotos pelo cliente"
         )
     elif etapa == "analise_gestor":
         # Cliente enviou fotos, notificar gestor
-        await enviar_email_notificacao(
+        enviar_email_notificacao(
             GESTORES_EMAILS[0],
             f"Atualização Ticket #{ticket_id[-8:]} - EcoGuard",
             f"O cliente {cliente_email} enviou as fotos. Acesse o sistema para análise."
         )
         # Notificar admin
-        await enviar_email_notificacao(
+        enviar_email_notificacao(
             ADMIN_EMAIL,
             f"Alerta: Ticket #{ticket_id[-8:]} - Fotos enviadas",
             f"Cliente: {cliente_email}<br>Status: Aguardando análise do gestor"
         )
     elif etapa == "finalizado":
         # Gestor finalizou, notificar cliente
-        await enviar_email_notificacao(
+        enviar_email_notificacao(
             cliente_email,
             f"Ticket #{ticket_id[-8:]} Concluído - EcoGuard",
             f"Seu ticket foi concluído. O relatório está disponível no sistema."
         )
         # Notificar admin
-        await enviar_email_notificacao(
+        enviar_email_notificacao(
             ADMIN_EMAIL,
             f"Alerta: Ticket #{ticket_id[-8:]} - Concluído",
             f"Cliente: {cliente_email}<br>Status: Ticket finalizado com relatório disponível"
@@ -1552,20 +2732,25 @@ async def upload_foto_area(
     user = await get_current_user(request)
     
     # Cliente envia foto
-    file_content = await foto.read()
-    file_id = await fs.upload_from_stream(
-        foto.filename,
-        io.BytesIO(file_content),
-        metadata={"content_type": foto.content_type}
-    )
+    file_id = await salvar_upload_gridfs(foto, "foto")
     
     # Salvar foto na área
-    await db.areas_criticas.update_one(
+    anterior = await db.areas_criticas.find_one_and_update(
         {"area_id": area_id},
-        {"$set": {"foto_cliente_id": str(file_id)}}
+        {"$set": {"foto_cliente_id": file_id, "updated_at": datetime.now(timezone.utc)}},
+        projection={"_id": 0, "foto_cliente_id": 1}
     )
+    if anterior is None or anterior.get("foto_cliente_id") == file_id:
+        # Área inexistente ou o mesmo blob reenviado: a referência nova sobra
+        await liberar_blob(file_id)
+        if anterior is None:
+            raise HTTPException(status_code=404, detail="Area not found")
+    else:
+        await liberar_blob(anterior.get("foto_cliente_id"))
+        em_background(gerar_derivados(file_id))
+    await invalidar_relatorio(ticket_id)
     
-    return {"message": "Foto enviada com sucesso", "foto_id": str(file_id)}
+    return {"message": "Foto enviada com sucesso", "foto_id": file_id}
 
 @api_router.post("/tickets/{ticket_id}/analise-area")
 async def analisar_area_gestor(
@@ -1586,9 +2771,11 @@ async def analisar_area_gestor(
         {"$set": {
             "situacao_gestor": situacao,
             "observacao_gestor": observacao,
-            "analisado_em": datetime.now(timezone.utc)
+            "analisado_em": datetime.now(timezone.utc),
+            "updated_at": datetime.now(timezone.utc)
         }}
     )
+    await invalidar_relatorio(ticket_id)
     
     return {"message": "Análise registrada"}
 
@@ -1605,7 +2792,7 @@ async def pode_criar_novo_ticket(empresa_id: str, request: Request):
     return {"pode_criar": ticket_aberto is None, "ticket_aberto": ticket_aberto}
 
 @api_router.get("/areas/{area_id}/foto-cliente")
-async def get_foto_cliente(area_id: str, request: Request):
+async def get_foto_cliente(area_id: str, request: Request, size: Optional[int] = None, v: Optional[str] = None):
     """Retorna a foto enviada pelo cliente para uma área crítica"""
     user = await get_current_user(request)
     
@@ -1616,13 +2803,13 @@ async def get_foto_cliente(area_id: str, request: Request):
     if not area.get("foto_cliente_id"):
         raise HTTPException(status_code=404, detail="Foto não encontrada")
     
-    from bson import ObjectId
-    try:
-        file_stream = await fs.open_download_stream(ObjectId(area["foto_cliente_id"]))
-        file_content = await file_stream.read()
-        return Response(content=file_content, media_type="image/jpeg")
-    except Exception as e:
-        raise HTTPException(status_code=404, detail="Foto não encontrada")
+    return await servir_arquivo_gridfs(
+        await arquivo_para_tamanho(area["foto_cliente_id"], size),
+        request,
+        media_type_padrao="image/jpeg",
+        nao_encontrado="Foto não encontrada",
+        imutavel=v == area["foto_cliente_id"]
+    )
 
 @api_router.delete("/tickets/{ticket_id}")
 async def delete_ticket(ticket_id: str, request: Request):
@@ -1641,6 +2828,7 @@ async def delete_ticket(ticket_id: str, request: Request):
         # Gestor pode excluir definitivamente
         await db.tickets.delete_one({"ticket_id": ticket_id})
         await db.ticket_mensagens.delete_many({"ticket_id": ticket_id})
+        await invalidar_relatorio(ticket_id)
         return {"message": "Ticket excluído definitivamente"}
     else:
         # Cliente apenas marca como excluído (gestor ainda vê)
@@ -1650,126 +2838,87 @@ async def delete_ticket(ticket_id: str, request: Request):
         )
         return {"message": "Ticket excluído"}
 
-@api_router.get("/tickets/{ticket_id}/relatorio")
-async def get_relatorio_ticket(ticket_id: str, request: Request):
-    """Gera relatório HTML do ticket finalizado com fotos"""
-    user = await get_current_user(request)
-    
-    ticket = await db.tickets.find_one({"ticket_id": ticket_id}, {"_id": 0})
-    if not ticket:
-        raise HTTPException(status_code=404, detail="Ticket não encontrado")
-    
-    # Verificar permissão
-    if not is_gestor(user) and ticket["user_id"] != user.user_id:
-        raise HTTPException(status_code=403, detail="Sem permissão")
-    
-    # Buscar dados completos
-    empresa = await db.empresas.find_one({"empresa_id": ticket["empresa_id"]}, {"_id": 0})
-    planta = await db.plantas_estabelecimento.find_one({"planta_id": ticket["planta_id"]}, {"_id": 0})
-    areas = await db.areas_criticas.find({"planta_id": ticket["planta_id"]}, {"_id": 0}).to_list(100)
-    mensagens = await db.ticket_mensagens.find({"ticket_id": ticket_id}, {"_id": 0}).sort("created_at", 1).to_list(1000)
-    
-    # Carregar fotos das áreas como base64
-    import base64
+# Relatório do ticket
+# Gerado como stream: o cabeçalho sai logo após as consultas de metadados e as
+# fotos são buscadas em paralelo numa janela de RELATORIO_CONCORRENCIA_FOTOS
+# áreas, codificadas em base64 em blocos; a memória depende da janela, não do
+# tamanho do relatório.
+RELATORIO_CONCORRENCIA_FOTOS = int(os.environ.get('RELATORIO_CONCORRENCIA_FOTOS', '4'))
+RELATORIO_BLOCO_BASE64 = 3 * 64 * 1024  # múltiplo de 3: blocos concatenados formam base64 válido
+
+RELATORIO_CSS = """        <style>
+            body { font-family: Arial, sans-serif; padding: 40px; color: #333; max-width: 900px; margin: 0 auto; }
+            .header { text-align: center; border-bottom: 2px solid #16a34a; padding-bottom: 20px; margin-bottom: 30px; }
+            .header h1 { color: #16a34a; margin: 0; }
+            .header p { color: #666; margin: 5px 0; }
+            .section { margin-bottom: 30px; }
+            .section h2 { color: #16a34a; border-bottom: 1px solid #ddd; padding-bottom: 10px; }
+            .info-grid { display: grid; grid-template-columns: 1fr 1fr; gap: 15px; }
+            .info-item { background: #f9f9f9; padding: 10px; border-radius: 5px; }
+            .info-item strong { color: #333; }
+            .area-card { border: 1px solid #ddd; border-radius: 8px; padding: 15px; margin-bottom: 20px; page-break-inside: avoid; }
+            .area-card.conforme { border-left: 4px solid #16a34a; }
+            .area-card.nao_conforme { border-left: 4px solid #dc2626; }
+            .area-card.nao_aplicavel { border-left: 4px solid #9ca3af; }
+            .area-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px; }
+            .area-info { margin-bottom: 10px; }
+            .area-info p { margin: 3px 0; font-size: 14px; }
+            .badge { display: inline-block; padding: 4px 12px; border-radius: 20px; font-size: 12px; font-weight: bold; }
+            .badge.conforme { background: #dcfce7; color: #16a34a; }
+            .badge.nao_conforme { background: #fee2e2; color: #dc2626; }
+            .badge.nao_aplicavel { background: #f3f4f6; color: #6b7280; }
+            .summary { display: flex; gap: 20px; justify-content: center; margin: 20px 0; flex-wrap: wrap; }
+            .summary-item { text-align: center; padding: 15px 25px; border-radius: 8px; min-width: 100px; }
+            .summary-item.green { background: #dcfce7; }
+            .summary-item.red { background: #fee2e2; }
+            .summary-item.gray { background: #f3f4f6; }
+            .summary-item .number { font-size: 32px; font-weight: bold; }
+            .summary-item .label { font-size: 12px; color: #666; }
+            .foto-container { margin: 10px 0; text-align: center; }
+            .area-foto { max-width: 100%; max-height: 400px; border-radius: 8px; border: 1px solid #ddd; }
+            .no-foto { background: #f5f5f5; padding: 30px; border-radius: 8px; color: #999; }
+            .observacao { background: #fff3cd; padding: 10px; border-radius: 5px; margin-top: 10px; font-size: 14px; }
+            .footer { text-align: center; margin-top: 40px; padding-top: 20px; border-top: 1px solid #ddd; color: #666; font-size: 12px; }
+            @media print {
+                body { padding: 20px; }
+                .area-card { page-break-inside: avoid; }
+            }
+        </style>
+"""
+
+SITUACAO_LABELS = {
+    "conforme": "✓ Conforme",
+    "nao_conforme": "✗ Não Conforme",
+    "nao_aplicavel": "— Não Aplicável"
+}
+
+async def _carregar_foto_relatorio(foto_id: str) -> Optional[tuple]:
     from bson import ObjectId
-    
-    areas_com_fotos = []
-    for area in areas:
-        area_data = dict(area)
-        foto_base64 = None
-        
-        if area.get("foto_cliente_id"):
-            try:
-                file_stream = await fs.open_download_stream(ObjectId(area["foto_cliente_id"]))
-                file_content = await file_stream.read()
-                foto_base64 = base64.b64encode(file_content).decode('utf-8')
-            except Exception as e:
-                logger.error(f"Erro ao carregar foto: {e}")
-        
-        area_data["foto_base64"] = foto_base64
-        areas_com_fotos.append(area_data)
+    try:
+        grid_out = await fs.open_download_stream(ObjectId(foto_id))
+        conteudo = await grid_out.read()
+        return conteudo, (grid_out.metadata or {}).get("content_type") or "image/jpeg"
+    except Exception as e:
+        logger.error(f"Erro ao carregar foto: {e}")
+        return None
+
+async def gerar_relatorio_html(ticket: dict, empresa: Optional[dict], areas: List[dict]):
+    """Gera o HTML do relatório em partes (bytes UTF-8)"""
+    ticket_id = ticket["ticket_id"]
     
     # Contabilizar análises
-    total_areas = len(areas_com_fotos)
-    conformes = len([a for a in areas_com_fotos if a.get("situacao_gestor") == "conforme"])
-    nao_conformes = len([a for a in areas_com_fotos if a.get("situacao_gestor") == "nao_conforme"])
-    nao_aplicaveis = len([a for a in areas_com_fotos if a.get("situacao_gestor") == "nao_aplicavel"])
-    
-    # Gerar HTML das áreas com fotos
-    areas_html = ""
-    for a in areas_com_fotos:
-        situacao = a.get('situacao_gestor', 'pendente')
-        situacao_label = '✓ Conforme' if situacao == 'conforme' else '✗ Não Conforme' if situacao == 'nao_conforme' else '— Não Aplicável' if situacao == 'nao_aplicavel' else 'Pendente'
-        
-        foto_html = ""
-        if a.get("foto_base64"):
-            foto_html = f'<div class="foto-container"><img src="data:image/jpeg;base64,{a["foto_base64"]}" alt="Foto da área" class="area-foto" /></div>'
-        else:
-            foto_html = '<div class="foto-container no-foto">📷 Sem foto disponível</div>'
-        
-        observacao_html = f'<p class="observacao"><strong>Observação do Gestor:</strong> {a.get("observacao_gestor")}</p>' if a.get('observacao_gestor') else ''
-        
-        areas_html += f'''
-        <div class="area-card {situacao}">
-            <div class="area-header">
-                <strong>{a.get('nome', 'Área')}</strong>
-                <span class="badge {situacao}">{situacao_label}</span>
-            </div>
-            <div class="area-info">
-                <p><strong>Tipo:</strong> {a.get('tipo_area', 'N/A')}</p>
-                <p><strong>Criticidade:</strong> {a.get('criticidade', 'N/A').upper()}</p>
-            </div>
-            {foto_html}
-            {observacao_html}
-        </div>
-        '''
+    total_areas = len(areas)
+    conformes = len([a for a in areas if a.get("situacao_gestor") == "conforme"])
+    nao_conformes = len([a for a in areas if a.get("situacao_gestor") == "nao_conforme"])
+    nao_aplicaveis = len([a for a in areas if a.get("situacao_gestor") == "nao_aplicavel"])
     
-    # Gerar HTML do relatório
-    html_content = f"""
+    yield f"""
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="UTF-8">
         <title>Relatório - Ticket #{ticket_id[-8:]}</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; padding: 40px; color: #333; max-width: 900px; margin: 0 auto; }}
-            .header {{ text-align: center; border-bottom: 2px solid #16a34a; padding-bottom: 20px; margin-bottom: 30px; }}
-            .header h1 {{ color: #16a34a; margin: 0; }}
-            .header p {{ color: #666; margin: 5px 0; }}
-            .section {{ margin-bottom: 30px; }}
-            .section h2 {{ color: #16a34a; border-bottom: 1px solid #ddd; padding-bottom: 10px; }}
-            .info-grid {{ display: grid; grid-template-columns: 1fr 1fr; gap: 15px; }}
-            .info-item {{ background: #f9f9f9; padding: 10px; border-radius: 5px; }}
-            .info-item strong {{ color: #333; }}
-            .area-card {{ border: 1px solid #ddd; border-radius: 8px; padding: 15px; margin-bottom: 20px; page-break-inside: avoid; }}
-            .area-card.conforme {{ border-left: 4px solid #16a34a; }}
-            .area-card.nao_conforme {{ border-left: 4px solid #dc2626; }}
-            .area-card.nao_aplicavel {{ border-left: 4px solid #9ca3af; }}
-            .area-header {{ display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px; }}
-            .area-info {{ margin-bottom: 10px; }}
-            .area-info p {{ margin: 3px 0; font-size: 14px; }}
-            .badge {{ display: inline-block; padding: 4px 12px; border-radius: 20px; font-size: 12px; font-weight: bold; }}
-            .badge.conforme {{ background: #dcfce7; color: #16a34a; }}
-            .badge.nao_conforme {{ background: #fee2e2; color: #dc2626; }}
-            .badge.nao_aplicavel {{ background: #f3f4f6; color: #6b7280; }}
-            .summary {{ display: flex; gap: 20px; justify-content: center; margin: 20px 0; flex-wrap: wrap; }}
-            .summary-item {{ text-align: center; padding: 15px 25px; border-radius: 8px; min-width: 100px; }}
-            .summary-item.green {{ background: #dcfce7; }}
-            .summary-item.red {{ background: #fee2e2; }}
-            .summary-item.gray {{ background: #f3f4f6; }}
-            .summary-item .number {{ font-size: 32px; font-weight: bold; }}
-            .summary-item .label {{ font-size: 12px; color: #666; }}
-            .foto-container {{ margin: 10px 0; text-align: center; }}
-            .area-foto {{ max-width: 100%; max-height: 400px; border-radius: 8px; border: 1px solid #ddd; }}
-            .no-foto {{ background: #f5f5f5; padding: 30px; border-radius: 8px; color: #999; }}
-            .observacao {{ background: #fff3cd; padding: 10px; border-radius: 5px; margin-top: 10px; font-size: 14px; }}
-            .footer {{ text-align: center; margin-top: 40px; padding-top: 20px; border-top: 1px solid #ddd; color: #666; font-size: 12px; }}
-            @media print {{
-                body {{ padding: 20px; }}
-                .area-card {{ page-break-inside: avoid; }}
-            }}
-        </style>
-    </head>
+{RELATORIO_CSS}    </head>
     <body>
         <div class="header">
             <h1>🌿 EcoGuard</h1>
@@ -1811,7 +2960,65 @@ async def get_relatorio_ticket(ticket_id: str, request: Request):
         
         <div class="section">
             <h2>Análise por Área ({total_areas} áreas)</h2>
-            {areas_html}
+    """.encode("utf-8")
+    
+    # Janela deslizante de fotos em carregamento
+    pendentes = iter(areas)
+    janela = deque()
+    
+    def agendar_proxima():
+        area = next(pendentes, None)
+        if area is not None:
+            tarefa = None
+            if area.get("foto_cliente_id"):
+                tarefa = asyncio.create_task(_carregar_foto_relatorio(area["foto_cliente_id"]))
+            janela.append((area, tarefa))
+    
+    for _ in range(max(RELATORIO_CONCORRENCIA_FOTOS, 1)):
+        agendar_proxima()
+    
+    try:
+        while janela:
+            a, tarefa = janela.popleft()
+            foto = await tarefa if tarefa else None
+            agendar_proxima()
+            
+            situacao = a.get('situacao_gestor', 'pendente')
+            situacao_label = SITUACAO_LABELS.get(situacao, 'Pendente')
+            yield f'''
+        <div class="area-card {situacao}">
+            <div class="area-header">
+                <strong>{a.get('nome', 'Área')}</strong>
+                <span class="badge {situacao}">{situacao_label}</span>
+            </div>
+            <div class="area-info">
+                <p><strong>Tipo:</strong> {a.get('tipo_area', 'N/A')}</p>
+                <p><strong>Criticidade:</strong> {a.get('criticidade', 'N/A').upper()}</p>
+            </div>
+            '''.encode("utf-8")
+            
+            if foto:
+                conteudo, media_type = foto
+                yield f'<div class="foto-container"><img src="data:{media_type};base64,'.encode("utf-8")
+                for i in range(0, len(conteudo), RELATORIO_BLOCO_BASE64):
+                    yield base64.b64encode(conteudo[i:i + RELATORIO_BLOCO_BASE64])
+                yield '" alt="Foto da área" class="area-foto" /></div>'.encode("utf-8")
+                del conteudo, foto
+            else:
+                yield '<div class="foto-container no-foto">📷 Sem foto disponível</div>'.encode("utf-8")
+            
+            observacao_html = f'<p class="observacao"><strong>Observação do Gestor:</strong> {a.get("observacao_gestor")}</p>' if a.get('observacao_gestor') else ''
+            yield f'''
+            {observacao_html}
+        </div>
+        '''.encode("utf-8")
+    finally:
+        # Cliente desconectou no meio do stream: não deixar downloads órfãos
+        for _, tarefa in janela:
+            if tarefa:
+                tarefa.cancel()
+    
+    yield f"""
         </div>
         
         <div class="footer">
@@ -1821,224 +3028,851 @@ async def get_relatorio_ticket(ticket_id: str, request: Request):
         </div>
     </body>
     </html>
-    """
-    
-    return Response(
-        content=html_content.encode('utf-8'),
-        media_type="text/html",
-        headers={"Content-Disposition": f"attachment; filename=relatorio_ticket_{ticket_id[-8:]}.html"}
+    """.encode("utf-8")
+
+# Cache persistente do relatório de tickets finalizados
+# O HTML renderizado é guardado no GridFS e indexado em relatorios_cache por
+# ticket_id com uma versão derivada das últimas alterações de ticket, empresa,
+# áreas e mensagens; versão diferente significa relatório desatualizado.
+# Versões substituídas não são apagadas na hora (um download pode estar lendo
+# o arquivo): ficam marcadas em metadata.relatorio_descartado_em e a limpeza
+# periódica as remove depois de RELATORIOS_RETENCAO_SECONDS.
+RELATORIOS_RETENCAO_SECONDS = float(os.environ.get('RELATORIOS_RETENCAO_SECONDS', '3600'))
+
+async def versao_relatorio(ticket: dict, empresa: Optional[dict], areas: List[dict]) -> str:
+    ultima_mensagem = await db.ticket_mensagens.find_one(
+        {"ticket_id": ticket["ticket_id"]},
+        {"_id": 0, "created_at": 1},
+        sort=[("created_at", -1)]
     )
+    marcas = [ticket.get("updated_at"), ticket.get("closed_at")]
+    if empresa:
+        marcas.append(empresa.get("updated_at"))
+    if ultima_mensagem:
+        marcas.append(ultima_mensagem.get("created_at"))
+    for area in areas:
+        marcas += [area.get("created_at"), area.get("updated_at"), area.get("analisado_em")]
+    marcas = [m.replace(tzinfo=None) for m in marcas if isinstance(m, datetime)]
+    return f"{max(marcas).isoformat() if marcas else ''}|{len(areas)}"
 
-# ========================================
-# Sistema de Alertas Automáticos
-# ========================================
+async def descartar_relatorio(arquivo_id: str):
+    """Marca uma versão substituída para remoção pela limpeza periódica"""
+    from bson import ObjectId
+    await db["fs.files"].update_one(
+        {"_id": ObjectId(arquivo_id)},
+        {"$set": {"metadata.relatorio_descartado_em": datetime.now(timezone.utc)}}
+    )
 
-async def verificar_licencas_vencendo():
-    """Verifica licenças próximas do vencimento e envia alertas por email"""
+async def registrar_relatorio(ticket_id: str, versao: str, arquivo_id: str):
+    anterior = await db.relatorios_cache.find_one_and_update(
+        {"ticket_id": ticket_id},
+        {"$set": {"versao": versao, "arquivo_id": arquivo_id, "created_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    if anterior and anterior["arquivo_id"] != arquivo_id:
+        await descartar_relatorio(anterior["arquivo_id"])
+
+async def invalidar_relatorio(ticket_id: str):
+    anterior = await db.relatorios_cache.find_one_and_delete({"ticket_id": ticket_id})
+    if anterior:
+        await descartar_relatorio(anterior["arquivo_id"])
+
+async def limpar_relatorios_descartados():
+    """Remove periodicamente versões de relatório descartadas há mais que a retenção"""
+    while True:
+        try:
+            limite = datetime.now(timezone.utc) - timedelta(seconds=RELATORIOS_RETENCAO_SECONDS)
+            removidos = 0
+            async for arquivo in db["fs.files"].find(
+                {"metadata.relatorio_descartado_em": {"$lt": limite}}, {"_id": 1}
+            ):
+                try:
+                    await fs.delete(arquivo["_id"])
+                    removidos += 1
+                except gridfs.NoFile:
+                    pass
+            if removidos:
+                logger.info(f"🧹 {removidos} relatórios descartados removidos")
+        except Exception as e:
+            logger.error(f"Erro ao remover relatórios descartados: {e}")
+        await asyncio.sleep(RELATORIOS_RETENCAO_SECONDS)
+
+async def renderizar_e_armazenar_relatorio(ticket: dict, empresa: Optional[dict], areas: List[dict], versao: str):
+    """Repassa as partes do relatório e as grava no GridFS ao mesmo tempo"""
+    grid_in = fs.open_upload_stream(
+        f"relatorio_{ticket['ticket_id']}.html",
+        metadata={"content_type": "text/html; charset=utf-8", "relatorio_ticket_id": ticket["ticket_id"]}
+    )
+    concluido = False
+    try:
+        async for parte in gerar_relatorio_html(ticket, empresa, areas):
+            await grid_in.write(parte)
+            yield parte
+        await grid_in.close()
+        concluido = True
+        await registrar_relatorio(ticket["ticket_id"], versao, str(grid_in._id))
+    finally:
+        if not concluido:
+            await grid_in.abort()
+
+async def _dados_relatorio(ticket: dict) -> tuple:
+    return await asyncio.gather(
+        db.empresas.find_one({"empresa_id": ticket["empresa_id"]}, {"_id": 0}),
+        db.areas_criticas.find({"planta_id": ticket["planta_id"]}, {"_id": 0}).to_list(100)
+    )
+
+async def pre_renderizar_relatorio(ticket_id: str):
+    """Renderiza em background o relatório de um ticket recém-finalizado"""
     try:
-        logger.info("🔔 Iniciando verificação de licenças...")
+        ticket = await db.tickets.find_one({"ticket_id": ticket_id}, {"_id": 0})
+        if not ticket or ticket.get("etapa") != "finalizado":
+            return
+        empresa, areas = await _dados_relatorio(ticket)
+        versao = await versao_relatorio(ticket, empresa, areas)
+        cache = await db.relatorios_cache.find_one({"ticket_id": ticket_id}, {"_id": 0})
+        if cache and cache["versao"] == versao:
+            return
+        async for _ in renderizar_e_armazenar_relatorio(ticket, empresa, areas, versao):
+            pass
+        logger.info(f"📄 Relatório do ticket {ticket_id} pré-renderizado")
+    except Exception as e:
+        logger.error(f"Erro ao pré-renderizar relatório do ticket {ticket_id}: {e}")
+
+@api_router.get("/tickets/{ticket_id}/relatorio")
+async def get_relatorio_ticket(ticket_id: str, request: Request):
+    """Gera relatório HTML do ticket finalizado com fotos"""
+    user = await get_current_user(request)
+    
+    ticket = await db.tickets.find_one({"ticket_id": ticket_id}, {"_id": 0})
+    if not ticket:
+        raise HTTPException(status_code=404, detail="Ticket não encontrado")
+    
+    # Verificar permissão
+    if not is_gestor(user) and ticket["user_id"] != user.user_id:
+        raise HTTPException(status_code=403, detail="Sem permissão")
+    
+    # Buscar dados completos
+    empresa, areas = await _dados_relatorio(ticket)
+    headers = {"Content-Disposition": f"attachment; filename=relatorio_ticket_{ticket_id[-8:]}.html"}
+    
+    if ticket.get("etapa") != "finalizado":
+        return StreamingResponse(
+            gerar_relatorio_html(ticket, empresa, areas),
+            media_type="text/html; charset=utf-8",
+            headers=headers
+        )
+    
+    # Ticket finalizado: servir do cache se a versão ainda for a atual
+    versao = await versao_relatorio(ticket, empresa, areas)
+    cache = await db.relatorios_cache.find_one({"ticket_id": ticket_id}, {"_id": 0})
+    if cache and cache["versao"] == versao:
+        try:
+            return await servir_arquivo_gridfs(
+                cache["arquivo_id"],
+                request,
+                media_type_padrao="text/html; charset=utf-8",
+                headers_extras=headers
+            )
+        except HTTPException:
+            logger.warning(f"Relatório em cache do ticket {ticket_id} não encontrado; renderizando")
+    
+    return StreamingResponse(
+        renderizar_e_armazenar_relatorio(ticket, empresa, areas, versao),
+        media_type="text/html; charset=utf-8",
+        headers=headers
+    )
+
+# Exportação em lote (ZIP) dos relatórios e fotos de uma empresa
+# O ZIP é montado em memória só o suficiente para cada parte enviada: o
+# zipfile escreve num buffer não pesquisável (usa data descriptors) que é
+# esvaziado a cada yield. Tickets saem em ordem de ticket_id, cada um na sua
+# pasta; se o download cair, basta repetir com ?apos=<último ticket completo>.
+EXPORTACAO_CONCORRENCIA_FOTOS = int(os.environ.get('EXPORTACAO_CONCORRENCIA_FOTOS', '8'))
+EXTENSOES_FOTO = {"image/jpeg": "jpg", "image/png": "png", "image/gif": "gif", "image/webp": "webp"}
+
+class _SaidaZip:
+    """Destino não pesquisável para o zipfile; acumula bytes até serem drenados"""
+    def __init__(self):
+        self._partes = []
+    
+    def write(self, dados) -> int:
+        self._partes.append(bytes(dados))
+        return len(dados)
+    
+    def flush(self):
+        pass
+    
+    def drenar(self) -> bytes:
+        dados = b"".join(self._partes)
+        self._partes.clear()
+        return dados
+
+def _nome_seguro(nome: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", nome, flags=re.ASCII).strip("_") or "area"
+
+def _data_zip(ticket: dict) -> tuple:
+    data = ticket.get("closed_at") or ticket.get("updated_at") or ticket.get("created_at")
+    if not isinstance(data, datetime) or data.year < 1980:
+        data = datetime.now(timezone.utc)
+    return data.timetuple()[:6]
+
+async def _partes_relatorio_exportacao(ticket: dict, empresa: Optional[dict], areas: List[dict]):
+    """Partes do relatório, lidas do cache quando atual ou renderizadas (e guardadas)"""
+    from bson import ObjectId
+    versao = await versao_relatorio(ticket, empresa, areas)
+    cache = await db.relatorios_cache.find_one({"ticket_id": ticket["ticket_id"]}, {"_id": 0})
+    if cache and cache["versao"] == versao:
+        try:
+            grid_out = await fs.open_download_stream(ObjectId(cache["arquivo_id"]))
+        except gridfs.NoFile:
+            grid_out = None
+        if grid_out is not None:
+            while True:
+                chunk = await grid_out.readchunk()
+                if not chunk:
+                    return
+                yield chunk
+    async for parte in renderizar_e_armazenar_relatorio(ticket, empresa, areas, versao):
+        yield parte
+
+async def gerar_exportacao_zip(empresa: dict, apos: Optional[str]):
+    filtro = {"empresa_id": empresa["empresa_id"], "etapa": "finalizado"}
+    if apos:
+        filtro["ticket_id"] = {"$gt": apos}
+    
+    saida = _SaidaZip()
+    zf = zipfile.ZipFile(saida, mode="w", allowZip64=True)
+    
+    async for ticket in db.tickets.find(filtro, {"_id": 0}).sort("ticket_id", 1):
+        ticket_id = ticket["ticket_id"]
+        data_zip = _data_zip(ticket)
+        areas = await db.areas_criticas.find({"planta_id": ticket["planta_id"]}, {"_id": 0}).to_list(None)
         
-        # Buscar todas as licenças
-        licencas = await db.licencas_documentos.find({}, {"_id": 0}).to_list(1000)
-        alertas_enviados = 0
+        # Começar a baixar as fotos enquanto o relatório é escrito
+        com_foto = iter([a for a in areas if a.get("foto_cliente_id")])
+        janela = deque()
         
-        for licenca in licencas:
-            data_validade = licenca.get("data_validade")
-            if not data_validade:
-                continue
-                
-            if isinstance(data_validade, str):
-                data_validade = datetime.fromisoformat(data_validade)
-            if data_validade.tzinfo is None:
-                data_validade = data_validade.replace(tzinfo=timezone.utc)
-            
-            dias_restantes = (data_validade - datetime.now(timezone.utc)).days
-            dias_alerta = licenca.get("dias_alerta_vencimento", 30)
-            
-            # Verificar se já enviamos alerta hoje para esta licença
-            alerta_key = f"{licenca['licenca_id']}_{datetime.now(timezone.utc).date()}"
-            alerta_existente = await db.alertas_enviados.find_one({"alerta_key": alerta_key})
-            
-            if alerta_existente:
-                continue  # Já enviamos alerta hoje
-            
-            # Determinar se precisa enviar alerta
-            deve_alertar = False
-            tipo_alerta = ""
-            
-            if dias_restantes < 0:
-                deve_alertar = True
-                tipo_alerta = "VENCIDA"
-            elif dias_restantes <= 7:
-                deve_alertar = True
-                tipo_alerta = "CRÍTICO"
-            elif dias_restantes <= dias_alerta:
-                deve_alertar = True
-                tipo_alerta = "ATENÇÃO"
+        def agendar_proxima():
+            area = next(com_foto, None)
+            if area is not None:
+                janela.append((area, asyncio.create_task(_carregar_foto_relatorio(area["foto_cliente_id"]))))
+        
+        for _ in range(max(EXPORTACAO_CONCORRENCIA_FOTOS, 1)):
+            agendar_proxima()
+        
+        try:
+            info = zipfile.ZipInfo(f"{ticket_id}/relatorio.html", date_time=data_zip)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(info, mode="w", force_zip64=True) as destino:
+                async for parte in _partes_relatorio_exportacao(ticket, empresa, areas):
+                    destino.write(parte)
+                    yield saida.drenar()
+            yield saida.drenar()
             
-            if deve_alertar:
-                # Buscar empresa para obter dados de contato
-                empresa = await db.empresas.find_one(
-                    {"empresa_id": licenca["empresa_id"]}, 
-                    {"_id": 0}
+            while janela:
+                area, tarefa = janela.popleft()
+                foto = await tarefa
+                agendar_proxima()
+                if not foto:
+                    continue
+                conteudo, media_type = foto
+                extensao = EXTENSOES_FOTO.get(media_type, "bin")
+                info = zipfile.ZipInfo(
+                    f"{ticket_id}/fotos/{_nome_seguro(area.get('nome', 'area'))}_{area['area_id']}.{extensao}",
+                    date_time=data_zip
                 )
-                
-                # Buscar usuário dono da empresa
-                if empresa:
-                    user = await db.users.find_one(
-                        {"user_id": empresa.get("user_id")},
-                        {"_id": 0}
-                    )
-                    
-                    if user and user.get("email"):
-                        # Montar mensagem de alerta
-                        if dias_restantes < 0:
-                            mensagem = f"""
-                            <strong style="color: #dc2626;">⚠️ LICENÇA VENCIDA!</strong><br><br>
-                            A licença <strong>{licenca['nome_licenca']}</strong> ({licenca['numero_licenca']}) 
-                            da empresa <strong>{empresa['nome']}</strong> está <strong>VENCIDA há {abs(dias_restantes)} dias</strong>.<br><br>
-                            <strong>Tipo:</strong> {licenca['tipo']}<br>
-                            <strong>Órgão Emissor:</strong> {licenca['orgao_emissor']}<br>
-                            <strong>Vencimento:</strong> {data_validade.strftime('%d/%m/%Y')}<br><br>
-                            Providencie a renovação imediatamente para evitar multas e sanções.
-                            """
-                        else:
-                            mensagem = f"""
-                            A licença <strong>{licenca['nome_licenca']}</strong> ({licenca['numero_licenca']}) 
-                            da empresa <strong>{empresa['nome']}</strong> vencerá em <strong>{dias_restantes} dias</strong>.<br><br>
-                            <strong>Tipo:</strong> {licenca['tipo']}<br>
-                            <strong>Órgão Emissor:</strong> {licenca['orgao_emissor']}<br>
-                            <strong>Vencimento:</strong> {data_validade.strftime('%d/%m/%Y')}<br><br>
-                            Providencie a renovação com antecedência para evitar problemas.
-                            """
-                        
-                        assunto = f"[{tipo_alerta}] Licença {licenca['nome_licenca']} - {dias_restantes} dias para vencer" if dias_restantes >= 0 else f"[VENCIDA] Licença {licenca['nome_licenca']} - AÇÃO URGENTE"
-                        
-                        # Enviar email para cliente
-                        await enviar_email_notificacao(user["email"], assunto, mensagem)
-                        
-                        # Notificar gestor
-                        await enviar_email_notificacao(GESTORES_EMAILS[0], assunto, mensagem)
-                        
-                        # Notificar admin
-                        await enviar_email_notificacao(ADMIN_EMAIL, assunto, mensagem)
-                        
-                        # Registrar que enviamos o alerta
-                        await db.alertas_enviados.insert_one({
-                            "alerta_key": alerta_key,
-                            "licenca_id": licenca["licenca_id"],
-                            "tipo_alerta": tipo_alerta,
-                            "dias_restantes": dias_restantes,
-                            "enviado_em": datetime.now(timezone.utc)
-                        })
-                        
-                        alertas_enviados += 1
-                        logger.info(f"📧 Alerta enviado: {licenca['nome_licenca']} ({tipo_alerta})")
-        
-        # Verificar condicionantes também
-        condicionantes = await db.condicionantes.find({}, {"_id": 0}).to_list(1000)
+                # Imagens já são comprimidas: armazenar sem deflate
+                info.compress_type = zipfile.ZIP_STORED
+                zf.writestr(info, conteudo)
+                yield saida.drenar()
+        finally:
+            for _, tarefa in janela:
+                tarefa.cancel()
+    
+    zf.close()
+    yield saida.drenar()
+
+@api_router.get("/empresas/{empresa_id}/exportacao")
+async def exportar_relatorios_empresa(empresa_id: str, request: Request, apos: Optional[str] = None):
+    """ZIP com o relatório e as fotos de cada ticket finalizado da empresa"""
+    user = await get_current_user(request)
+    
+    empresa = await db.empresas.find_one({"empresa_id": empresa_id}, {"_id": 0})
+    if not empresa or (not is_gestor(user) and empresa.get("user_id") != user.user_id):
+        raise HTTPException(status_code=404, detail="Empresa not found")
+    
+    nome = _nome_seguro(empresa.get("nome", empresa_id))
+    return StreamingResponse(
+        gerar_exportacao_zip(empresa, apos),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=relatorios_{nome}.zip"}
+    )
+
+# ========================================
+# Sistema de Alertas Automáticos
+# ========================================
+
+# A varredura só lê o que está dentro do horizonte de alerta (consultas por
+# faixa nos índices de data_validade / data_acompanhamento) e resolve chaves
+# já enviadas, empresas, usuários e licenças em leituras $in em lote.
+ALERTA_HORIZONTE_CONDICIONANTE_DIAS = 15
+ALERTA_DIAS_CRITICO = 7
+
+def _como_utc(data) -> datetime:
+    if isinstance(data, str):
+        data = datetime.fromisoformat(data)
+    if data.tzinfo is None:
+        data = data.replace(tzinfo=timezone.utc)
+    return data
+
+def _classificar_alerta(dias_restantes: int, dias_alerta: int) -> Optional[str]:
+    if dias_restantes < 0:
+        return "VENCIDA"
+    if dias_restantes <= ALERTA_DIAS_CRITICO:
+        return "CRÍTICO"
+    if dias_restantes <= dias_alerta:
+        return "ATENÇÃO"
+    return None
+
+# Agenda de prazos: cada licença/condicionante guarda em next_alert_at o
+# próximo instante em que pode gerar alerta (início da janela de alerta ou,
+# dentro dela, o próximo dia). O scheduler mantém um min-heap com os prazos
+# próximos e dorme até o primeiro deles; escritas reagendam na hora.
+ALERTAS_RESINCRONIZACAO_SECONDS = int(os.environ.get('ALERTAS_RESINCRONIZACAO_SECONDS', '3600'))
+
+def proximo_alerta(data_limite, dias_alerta: int, agora: datetime, verificado_hoje: bool) -> datetime:
+    """Próximo instante em que o documento entra (ou volta) a ser alertado"""
+    inicio_janela = _como_utc(data_limite) - timedelta(days=dias_alerta + 1)
+    if inicio_janela > agora:
+        return inicio_janela
+    if not verificado_hoje:
+        return agora
+    amanha = agora.date() + timedelta(days=1)
+    return datetime(amanha.year, amanha.month, amanha.day, tzinfo=timezone.utc)
+
+def proximo_alerta_licenca(licenca: dict, agora: datetime, verificado_hoje: bool = False) -> Optional[datetime]:
+    if not licenca.get("data_validade"):
+        return None
+    return proximo_alerta(licenca["data_validade"], licenca.get("dias_alerta_vencimento", 30), agora, verificado_hoje)
+
+def proximo_alerta_condicionante(cond: dict, agora: datetime, verificado_hoje: bool = False) -> Optional[datetime]:
+    if not cond.get("data_acompanhamento"):
+        return None
+    return proximo_alerta(cond["data_acompanhamento"], ALERTA_HORIZONTE_CONDICIONANTE_DIAS, agora, verificado_hoje)
+
+class AgendaAlertas:
+    """Min-heap de (next_alert_at, chave) com remoção preguiçosa"""
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._atual: Dict[tuple, datetime] = {}
+        # Escritas feitas enquanto sincronizar() lê o Mongo; None = removida
+        self._alteracoes: Optional[Dict[tuple, Optional[datetime]]] = None
+        self.evento = asyncio.Event()
+
+    def agendar(self, chave: tuple, instante: Optional[datetime], acordar: bool = True):
+        if instante is None:
+            self.remover(chave)
+            return
+        instante = _como_utc(instante)
+        if self._alteracoes is not None:
+            self._alteracoes[chave] = instante
+        if self._atual.get(chave) == instante:
+            return
+        self._atual[chave] = instante
+        heapq.heappush(self._heap, (instante, chave))
+        if acordar:
+            self.evento.set()
+
+    def remover(self, chave: tuple):
+        if self._alteracoes is not None:
+            self._alteracoes[chave] = None
+        if self._atual.pop(chave, None) is not None:
+            self.evento.set()
+
+    def proximo(self) -> Optional[datetime]:
+        while self._heap:
+            instante, chave = self._heap[0]
+            if self._atual.get(chave) == instante:
+                return instante
+            heapq.heappop(self._heap)
+        return None
+
+    async def sincronizar(self, agora: datetime):
+        """Carrega do Mongo os prazos até o próximo ciclo de resincronização.
+
+        agendar()/remover() chamados durante a leitura são mais novos que o
+        resultado dela e prevalecem sobre ele.
+        """
+        limite = agora + timedelta(seconds=2 * ALERTAS_RESINCRONIZACAO_SECONDS)
+        self._alteracoes = {}
+        try:
+            licencas, condicionantes = await asyncio.gather(
+                db.licencas_documentos.find(
+                    {"next_alert_at": {"$lte": limite}}, {"_id": 0, "licenca_id": 1, "next_alert_at": 1}
+                ).to_list(None),
+                db.condicionantes.find(
+                    {"next_alert_at": {"$lte": limite}}, {"_id": 0, "condicionante_id": 1, "next_alert_at": 1}
+                ).to_list(None)
+            )
+        finally:
+            alteracoes, self._alteracoes = self._alteracoes, None
         
-        for cond in condicionantes:
-            data_acompanhamento = cond.get("data_acompanhamento")
-            if not data_acompanhamento:
+        atual = {("licenca", l["licenca_id"]): _como_utc(l["next_alert_at"]) for l in licencas}
+        atual.update({("condicionante", c["condicionante_id"]): _como_utc(c["next_alert_at"]) for c in condicionantes})
+        for chave, instante in alteracoes.items():
+            if instante is None:
+                atual.pop(chave, None)
+            else:
+                atual[chave] = instante
+        self._atual = atual
+        self._heap = [(instante, chave) for chave, instante in atual.items()]
+        heapq.heapify(self._heap)
+
+    async def aguardar(self, segundos: float) -> bool:
+        """Dorme até o timeout ou até uma escrita reagendar algo; True se acordado"""
+        self.evento.clear()
+        try:
+            await asyncio.wait_for(self.evento.wait(), timeout=max(segundos, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+agenda_alertas = AgendaAlertas()
+
+async def recalcular_licenca(licenca: dict) -> dict:
+    """Regrava status e next_alert_at após mudança de validade ou antecedência"""
+    agora = datetime.now(timezone.utc)
+    campos = {"next_alert_at": proximo_alerta_licenca(licenca, agora)}
+    if licenca.get("data_validade"):
+        campos["status"] = calcular_status_licenca(
+            licenca["data_validade"], licenca.get("dias_alerta_vencimento", 30), agora
+        )
+    await db.licencas_documentos.update_one({"licenca_id": licenca["licenca_id"]}, {"$set": campos})
+    agenda_alertas.agendar(("licenca", licenca["licenca_id"]), campos["next_alert_at"])
+    return campos
+
+async def reagendar_condicionante(cond: dict):
+    instante = proximo_alerta_condicionante(cond, datetime.now(timezone.utc))
+    await db.condicionantes.update_one(
+        {"condicionante_id": cond["condicionante_id"]}, {"$set": {"next_alert_at": instante}}
+    )
+    agenda_alertas.agendar(("condicionante", cond["condicionante_id"]), instante)
+
+async def preencher_next_alert_at():
+    """Calcula next_alert_at de documentos antigos que ainda não o têm"""
+    agora = datetime.now(timezone.utc)
+    for colecao, campo, calcular in [
+        (db.licencas_documentos, "licenca_id", proximo_alerta_licenca),
+        (db.condicionantes, "condicionante_id", proximo_alerta_condicionante),
+    ]:
+        operacoes = []
+        async for doc in colecao.find({"next_alert_at": {"$exists": False}}, {"_id": 0}):
+            operacoes.append(UpdateOne({campo: doc[campo]}, {"$set": {"next_alert_at": calcular(doc, agora)}}))
+            if len(operacoes) >= 1000:
+                await colecao.bulk_write(operacoes, ordered=False)
+                operacoes = []
+        if operacoes:
+            await colecao.bulk_write(operacoes, ordered=False)
+
+async def coletar_alertas_pendentes(agora: datetime) -> List[dict]:
+    """Monta os alertas devidos hoje e ainda não enviados.
+
+    Todos os documentos lidos têm next_alert_at reagendado.
+    """
+    licencas, condicionantes = await asyncio.gather(
+        db.licencas_documentos.find(
+            {"$or": [
+                {"data_validade": {"$lte": agora + timedelta(days=ALERTA_HORIZONTE_MAXIMO_DIAS + 1)}},
+                {"next_alert_at": {"$lte": agora}}
+            ]},
+            {"_id": 0}
+        ).to_list(None),
+        db.condicionantes.find(
+            {"$or": [
+                {"data_acompanhamento": {"$lte": agora + timedelta(days=ALERTA_HORIZONTE_CONDICIONANTE_DIAS + 1)}},
+                {"next_alert_at": {"$lte": agora}}
+            ]},
+            {"_id": 0}
+        ).to_list(None)
+    )
+    hoje = agora.date()
+    
+    candidatos = []
+    for licenca in licencas:
+        if not licenca.get("data_validade"):
+            continue
+        data_validade = _como_utc(licenca["data_validade"])
+        dias_restantes = (data_validade - agora).days
+        tipo_alerta = _classificar_alerta(dias_restantes, licenca.get("dias_alerta_vencimento", 30))
+        if tipo_alerta:
+            candidatos.append(("licenca", f"{licenca['licenca_id']}_{hoje}", licenca, data_validade, dias_restantes, tipo_alerta))
+    for cond in condicionantes:
+        if not cond.get("data_acompanhamento"):
+            continue
+        data_acompanhamento = _como_utc(cond["data_acompanhamento"])
+        dias_restantes = (data_acompanhamento - agora).days
+        tipo_alerta = _classificar_alerta(dias_restantes, ALERTA_HORIZONTE_CONDICIONANTE_DIAS)
+        if tipo_alerta and cond.get("responsavel_email"):
+            candidatos.append(("condicionante", f"cond_{cond['condicionante_id']}_{hoje}", cond, data_acompanhamento, dias_restantes, tipo_alerta))
+    
+    # Reagendar tudo o que foi lido: dentro da janela, volta amanhã
+    for colecao, campo, tipo, docs, calcular in [
+        (db.licencas_documentos, "licenca_id", "licenca", licencas, proximo_alerta_licenca),
+        (db.condicionantes, "condicionante_id", "condicionante", condicionantes, proximo_alerta_condicionante),
+    ]:
+        operacoes = []
+        for doc in docs:
+            instante = calcular(doc, agora, verificado_hoje=True)
+            agenda_alertas.agendar((tipo, doc[campo]), instante, acordar=False)
+            if instante != (_como_utc(doc["next_alert_at"]) if doc.get("next_alert_at") else None):
+                operacoes.append(UpdateOne({campo: doc[campo]}, {"$set": {"next_alert_at": instante}}))
+        if operacoes:
+            await colecao.bulk_write(operacoes, ordered=False)
+    
+    if not candidatos:
+        return []
+    
+    # Chaves já enviadas hoje
+    ja_enviados = set(await db.alertas_enviados.distinct(
+        "alerta_key", {"alerta_key": {"$in": [c[1] for c in candidatos]}}
+    ))
+    candidatos = [c for c in candidatos if c[1] not in ja_enviados]
+    
+    # Empresas das licenças e licenças das condicionantes
+    empresa_ids = {c[2]["empresa_id"] for c in candidatos if c[0] == "licenca"}
+    licenca_ids = {c[2]["licenca_id"] for c in candidatos if c[0] == "condicionante"}
+    empresas, licencas_cond = await asyncio.gather(
+        db.empresas.find({"empresa_id": {"$in": list(empresa_ids)}}, {"_id": 0}).to_list(None),
+        db.licencas_documentos.find({"licenca_id": {"$in": list(licenca_ids)}}, {"_id": 0}).to_list(None)
+    )
+    empresas = {e["empresa_id"]: e for e in empresas}
+    licencas_cond = {l["licenca_id"]: l for l in licencas_cond}
+    
+    # Donos das empresas
+    user_ids = list({e.get("user_id") for e in empresas.values() if e.get("user_id")})
+    users = {
+        u["user_id"]: u
+        for u in await db.users.find({"user_id": {"$in": user_ids}}, {"_id": 0}).to_list(None)
+    }
+    
+    alertas = []
+    for tipo, alerta_key, doc, data, dias_restantes, tipo_alerta in candidatos:
+        if tipo == "licenca":
+            licenca = doc
+            empresa = empresas.get(licenca["empresa_id"])
+            user = users.get(empresa.get("user_id")) if empresa else None
+            if not user or not user.get("email"):
                 continue
-                
-            if isinstance(data_acompanhamento, str):
-                data_acompanhamento = datetime.fromisoformat(data_acompanhamento)
-            if data_acompanhamento.tzinfo is None:
-                data_acompanhamento = data_acompanhamento.replace(tzinfo=timezone.utc)
             
-            dias_restantes = (data_acompanhamento - datetime.now(timezone.utc)).days
-            
-            # Verificar se já enviamos alerta hoje
-            alerta_key = f"cond_{cond['condicionante_id']}_{datetime.now(timezone.utc).date()}"
-            alerta_existente = await db.alertas_enviados.find_one({"alerta_key": alerta_key})
+            # Montar mensagem de alerta
+            if dias_restantes < 0:
+                mensagem = f"""
+                <strong style="color: #dc2626;">⚠️ LICENÇA VENCIDA!</strong><br><br>
+                A licença <strong>{licenca['nome_licenca']}</strong> ({licenca['numero_licenca']}) 
+                da empresa <strong>{empresa['nome']}</strong> está <strong>VENCIDA há {abs(dias_restantes)} dias</strong>.<br><br>
+                <strong>Tipo:</strong> {licenca['tipo']}<br>
+                <strong>Órgão Emissor:</strong> {licenca['orgao_emissor']}<br>
+                <strong>Vencimento:</strong> {data.strftime('%d/%m/%Y')}<br><br>
+                Providencie a renovação imediatamente para evitar multas e sanções.
+                """
+            else:
+                mensagem = f"""
+                A licença <strong>{licenca['nome_licenca']}</strong> ({licenca['numero_licenca']}) 
+                da empresa <strong>{empresa['nome']}</strong> vencerá em <strong>{dias_restantes} dias</strong>.<br><br>
+                <strong>Tipo:</strong> {licenca['tipo']}<br>
+                <strong>Órgão Emissor:</strong> {licenca['orgao_emissor']}<br>
+                <strong>Vencimento:</strong> {data.strftime('%d/%m/%Y')}<br><br>
+                Providencie a renovação com antecedência para evitar problemas.
+                """
             
-            if alerta_existente:
+            assunto = f"[{tipo_alerta}] Licença {licenca['nome_licenca']} - {dias_restantes} dias para vencer" if dias_restantes >= 0 else f"[VENCIDA] Licença {licenca['nome_licenca']} - AÇÃO URGENTE"
+            alertas.append({
+                "destinatario": user["email"],
+                "assunto": assunto,
+                "mensagem": mensagem,
+                "descricao": f"Licença {licenca['nome_licenca']}",
+                "registro": {
+                    "alerta_key": alerta_key,
+                    "licenca_id": licenca["licenca_id"],
+                    "tipo_alerta": tipo_alerta,
+                    "dias_restantes": dias_restantes
+                }
+            })
+        else:
+            cond = doc
+            licenca = licencas_cond.get(cond["licenca_id"])
+            if not licenca:
                 continue
             
-            # Determinar se precisa enviar alerta
-            deve_alertar = False
-            tipo_alerta = ""
-            
+            # Montar mensagem baseada no tipo de alerta
             if dias_restantes < 0:
-                deve_alertar = True
-                tipo_alerta = "VENCIDA"
-            elif dias_restantes <= 7:
-                deve_alertar = True
-                tipo_alerta = "CRÍTICO"
-            elif dias_restantes <= 15:
-                deve_alertar = True
-                tipo_alerta = "ATENÇÃO"
-            
-            if deve_alertar:
-                # Buscar licença associada
-                licenca = await db.licencas_documentos.find_one(
-                    {"licenca_id": cond["licenca_id"]},
-                    {"_id": 0}
-                )
-                
-                if licenca and cond.get("responsavel_email"):
-                    # Montar mensagem baseada no tipo de alerta
-                    if dias_restantes < 0:
-                        mensagem = f"""
-                        <strong style="color: #dc2626;">⚠️ CONDICIONANTE VENCIDA!</strong><br><br>
-                        A condicionante <strong>{cond['nome']}</strong> da licença <strong>{licenca['nome_licenca']}</strong> 
-                        está <strong>VENCIDA há {abs(dias_restantes)} dias</strong>.<br><br>
-                        <strong>Descrição:</strong> {cond['descricao']}<br>
-                        <strong>Data prevista:</strong> {data_acompanhamento.strftime('%d/%m/%Y')}<br>
-                        <strong>Responsável:</strong> {cond['responsavel_nome']}<br>
-                        <strong>Status:</strong> {cond.get('status', 'em_andamento')}<br><br>
-                        <strong style="color: #dc2626;">AÇÃO URGENTE NECESSÁRIA!</strong> Verifique o cumprimento desta condicionante imediatamente.
-                        """
-                        assunto = f"[{tipo_alerta}] Condicionante {cond['nome']} - VENCIDA há {abs(dias_restantes)} dias"
-                    else:
-                        mensagem = f"""
-                        A condicionante <strong>{cond['nome']}</strong> da licença <strong>{licenca['nome_licenca']}</strong> 
-                        tem prazo de acompanhamento em <strong>{dias_restantes} dias</strong>.<br><br>
-                        <strong>Descrição:</strong> {cond['descricao']}<br>
-                        <strong>Data:</strong> {data_acompanhamento.strftime('%d/%m/%Y')}<br>
-                        <strong>Responsável:</strong> {cond['responsavel_nome']}<br>
-                        <strong>Status:</strong> {cond.get('status', 'em_andamento')}<br><br>
-                        Verifique o cumprimento desta condicionante.
-                        """
-                        assunto = f"[{tipo_alerta}] Condicionante {cond['nome']} - Prazo em {dias_restantes} dias"
-                    
-                    # Notificar responsável
-                    await enviar_email_notificacao(cond["responsavel_email"], assunto, mensagem)
-                    # Notificar gestor
-                    await enviar_email_notificacao(GESTORES_EMAILS[0], assunto, mensagem)
-                    # Notificar admin
-                    await enviar_email_notificacao(ADMIN_EMAIL, assunto, mensagem)
-                    
-                    await db.alertas_enviados.insert_one({
-                        "alerta_key": alerta_key,
-                        "condicionante_id": cond["condicionante_id"],
-                        "tipo_alerta": tipo_alerta,
-                        "dias_restantes": dias_restantes,
-                        "enviado_em": datetime.now(timezone.utc)
-                    })
-                    
-                    alertas_enviados += 1
-                    logger.info(f"📧 Alerta de condicionante enviado: {cond['nome']} ({tipo_alerta})")
-        
-        logger.info(f"✅ Verificação concluída. {alertas_enviados} alertas enviados.")
-        return alertas_enviados
-        
-    except Exception as e:
-        logger.error(f"Erro na verificação de licenças: {e}")
-        return 0
+                mensagem = f"""
+                <strong style="color: #dc2626;">⚠️ CONDICIONANTE VENCIDA!</strong><br><br>
+                A condicionante <strong>{cond['nome']}</strong> da licença <strong>{licenca['nome_licenca']}</strong> 
+                está <strong>VENCIDA há {abs(dias_restantes)} dias</strong>.<br><br>
+                <strong>Descrição:</strong> {cond['descricao']}<br>
+                <strong>Data prevista:</strong> {data.strftime('%d/%m/%Y')}<br>
+                <strong>Responsável:</strong> {cond['responsavel_nome']}<br>
+                <strong>Status:</strong> {cond.get('status', 'em_andamento')}<br><br>
+                <strong style="color: #dc2626;">AÇÃO URGENTE NECESSÁRIA!</strong> Verifique o cumprimento desta condicionante imediatamente.
+                """
+                assunto = f"[{tipo_alerta}] Condicionante {cond['nome']} - VENCIDA há {abs(dias_restantes)} dias"
+            else:
+                mensagem = f"""
+                A condicionante <strong>{cond['nome']}</strong> da licença <strong>{licenca['nome_licenca']}</strong> 
+                tem prazo de acompanhamento em <strong>{dias_restantes} dias</strong>.<br><br>
+                <strong>Descrição:</strong> {cond['descricao']}<br>
+                <strong>Data:</strong> {data.strftime('%d/%m/%Y')}<br>
+                <strong>Responsável:</strong> {cond['responsavel_nome']}<br>
+                <strong>Status:</strong> {cond.get('status', 'em_andamento')}<br><br>
+                Verifique o cumprimento desta condicionante.
+                """
+                assunto = f"[{tipo_alerta}] Condicionante {cond['nome']} - Prazo em {dias_restantes} dias"
+            alertas.append({
+                "destinatario": cond["responsavel_email"],
+                "assunto": assunto,
+                "mensagem": mensagem,
+                "descricao": f"Condicionante {cond['nome']}",
+                "registro": {
+                    "alerta_key": alerta_key,
+                    "condicionante_id": cond["condicionante_id"],
+                    "tipo_alerta": tipo_alerta,
+                    "dias_restantes": dias_restantes
+                }
+            })
+    return alertas
+
+# Cada destinatário recebe um único resumo por execução, com os alertas mais
+# graves primeiro e no máximo ALERTAS_DIGEST_MAX_ITENS itens detalhados.
+ALERTAS_DIGEST_MAX_ITENS = int(os.environ.get('ALERTAS_DIGEST_MAX_ITENS', '50'))
+SEVERIDADE_ALERTA = {"VENCIDA": 0, "CRÍTICO": 1, "ATENÇÃO": 2}
+
+def montar_digest_alertas(alertas: List[dict]) -> tuple:
+    """Retorna (assunto, mensagem) do resumo de alertas de um destinatário"""
+    alertas = sorted(alertas, key=lambda a: (
+        SEVERIDADE_ALERTA.get(a["registro"]["tipo_alerta"], 99),
+        a["registro"]["dias_restantes"]
+    ))
+    if len(alertas) == 1:
+        return alertas[0]["assunto"], alertas[0]["mensagem"]
+    
+    contagem = {}
+    for alerta in alertas:
+        tipo = alerta["registro"]["tipo_alerta"]
+        contagem[tipo] = contagem.get(tipo, 0) + 1
+    resumo = ", ".join(f"{total} {tipo}" for tipo, total in sorted(
+        contagem.items(), key=lambda c: SEVERIDADE_ALERTA.get(c[0], 99)
+    ))
+    pior = alertas[0]["registro"]["tipo_alerta"]
+    assunto = f"[{pior}] {len(alertas)} alertas de vencimento - EcoGuard"
+    
+    detalhados = alertas[:ALERTAS_DIGEST_MAX_ITENS]
+    mensagem = f"<strong>{len(alertas)} alertas de vencimento:</strong> {resumo}.<br><br>"
+    mensagem += '<hr style="border: none; border-top: 1px solid #eee; margin: 20px 0;">'.join(
+        f"<strong>{a['assunto']}</strong><br>{a['mensagem']}" for a in detalhados
+    )
+    restantes = len(alertas) - len(detalhados)
+    if restantes > 0:
+        mensagem += f"<br><br><em>E mais {restantes} alertas. Acesse o sistema para ver a lista completa.</em>"
+    return assunto, mensagem
+
+# Reserva de alertas
+# Antes de enfileirar, cada alerta_key é reservado (status pendente) sob o
+# lease, atrás do índice único de alertas_reservas: outra varredura, manual ou
+# do scheduler, não reenvia o que já está na fila. Na entrega a reserva passa
+# a enviado e o alerta vai para alertas_enviados; na falha a reserva é apagada
+# e a próxima varredura tenta de novo. Reservas pendentes de um processo que
+# morreu expiram pelo TTL em expira_em.
+ALERTAS_RESERVA_SECONDS = int(os.environ.get('ALERTAS_RESERVA_SECONDS', '3600'))
+
+async def reservar_alertas(alertas: List[dict], agora: datetime) -> List[dict]:
+    """Reserva os alerta_key livres e retorna só os alertas reservados"""
+    if not alertas:
+        return []
+    expira_em = agora + timedelta(seconds=ALERTAS_RESERVA_SECONDS)
+    ocupados = set()
+    try:
+        await db.alertas_reservas.insert_many(
+            [
+                {"alerta_key": a["registro"]["alerta_key"], "status": "pendente",
+                 "reservado_em": agora, "expira_em": expira_em}
+                for a in alertas
+            ],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        for erro in e.details.get("writeErrors", []):
+            if erro.get("code") != 11000:
+                raise
+            ocupados.add(alertas[erro["index"]]["registro"]["alerta_key"])
+    return [a for a in alertas if a["registro"]["alerta_key"] not in ocupados]
+
+async def registrar_alertas_enviados(alertas: List[dict]):
+    agora = datetime.now(timezone.utc)
+    chaves = [a["registro"]["alerta_key"] for a in alertas]
+    await db.alertas_enviados.insert_many(
+        [{**a["registro"], "enviado_em": agora} for a in alertas],
+        ordered=False
+    )
+    # alerta_key é diário: a reserva enviada só precisa durar até o dia seguinte
+    await db.alertas_reservas.update_many(
+        {"alerta_key": {"$in": chaves}},
+        {"$set": {"status": "enviado", "expira_em": agora + timedelta(days=2)}}
+    )
+
+async def liberar_alertas(alertas: List[dict]):
+    await db.alertas_reservas.delete_many(
+        {"alerta_key": {"$in": [a["registro"]["alerta_key"] for a in alertas]}, "status": "pendente"}
+    )
+
+async def verificar_licencas_vencendo():
+    """Verifica licenças e condicionantes próximas do vencimento e envia alertas por email.
+
+    Erros de banco são propagados: quem chama decide entre responder com erro
+    (endpoint manual) ou esperar e tentar de novo (scheduler).
+    """
+    logger.info("🔔 Iniciando verificação de licenças...")
+    agora = datetime.now(timezone.utc)
+    alertas = await reservar_alertas(await coletar_alertas_pendentes(agora), agora)
+    
+    # Agrupar por destinatário: dono/responsável, gestor e admin
+    por_destinatario: Dict[str, List[dict]] = {}
+    for alerta in alertas:
+        for email in {alerta["destinatario"].lower(), GESTORES_EMAILS[0].lower(), ADMIN_EMAIL.lower()}:
+            por_destinatario.setdefault(email, []).append(alerta)
+    
+    # Cada alerta é registrado quando o resumo do seu próprio destinatário é
+    # entregue; sem entrega a reserva é liberada para a próxima varredura.
+    enfileirados = 0
+    for email, itens in por_destinatario.items():
+        assunto, mensagem = montar_digest_alertas(itens)
+        proprios = [a for a in itens if a["destinatario"].lower() == email]
+        ao_entregar = ao_falhar = None
+        if proprios:
+            ao_entregar = lambda proprios=proprios: registrar_alertas_enviados(proprios)
+            ao_falhar = lambda proprios=proprios: liberar_alertas(proprios)
+        if enviar_email_notificacao(email, assunto, mensagem, ao_entregar, ao_falhar):
+            enfileirados += len(proprios)
+            logger.info(f"📧 Resumo de {len(itens)} alertas enfileirado para {email}")
+        elif proprios:
+            await liberar_alertas(proprios)
+    
+    logger.info(f"✅ Verificação concluída. {enfileirados} de {len(alertas)} alertas enfileirados.")
+    return enfileirados
+
+# Exclusão mútua entre processos (vários workers do uvicorn/gunicorn)
+# Um documento em `locks` funciona como lease: quem o adquire renova
+# expira_em enquanto trabalha; se o processo morrer, outro assume assim que o
+# lease expira. ultima_execucao registra a última varredura concluída.
+INSTANCIA_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+ALERTAS_LEASE_SECONDS = int(os.environ.get('ALERTAS_LEASE_SECONDS', '60'))
+ALERTAS_BACKOFF_SECONDS = float(os.environ.get('ALERTAS_BACKOFF_SECONDS', '60'))
+
+class MongoLease:
+    """Lease nomeado guardado em db.locks, adquirido via find_one_and_update"""
+
+    def __init__(self, nome: str, duracao_segundos: int):
+        self.nome = nome
+        self.duracao = timedelta(seconds=duracao_segundos)
+
+    async def adquirir(self) -> bool:
+        agora = datetime.now(timezone.utc)
+        try:
+            # Sem documento compatível o upsert colide no _id: lease ocupado
+            await db.locks.find_one_and_update(
+                {"_id": self.nome, "expira_em": {"$lt": agora}},
+                {"$set": {"dono": INSTANCIA_ID, "expira_em": agora + self.duracao, "adquirido_em": agora}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def renovar(self) -> bool:
+        result = await db.locks.update_one(
+            {"_id": self.nome, "dono": INSTANCIA_ID},
+            {"$set": {"expira_em": datetime.now(timezone.utc) + self.duracao}}
+        )
+        return result.matched_count == 1
+
+    async def liberar(self, concluido: bool):
+        agora = datetime.now(timezone.utc)
+        campos = {"expira_em": agora}
+        if concluido:
+            campos["ultima_execucao"] = agora
+        await db.locks.update_one({"_id": self.nome, "dono": INSTANCIA_ID}, {"$set": campos})
+
+    async def executar(self, funcao) -> tuple:
+        """Executa funcao() sob o lease, com heartbeat. Retorna (executou, resultado)"""
+        if not await self.adquirir():
+            return False, None
+        tarefa = asyncio.create_task(funcao())
+        concluido = False
+        try:
+            while True:
+                feitas, _ = await asyncio.wait({tarefa}, timeout=self.duracao.total_seconds() / 3)
+                if feitas:
+                    resultado = tarefa.result()
+                    concluido = True
+                    return True, resultado
+                if not await self.renovar():
+                    logger.warning(f"Lease {self.nome} perdido; execução interrompida")
+                    return False, None
+        finally:
+            if not tarefa.done():
+                tarefa.cancel()
+            await self.liberar(concluido)
+
+lease_alertas = MongoLease("scheduler_alertas", ALERTAS_LEASE_SECONDS)
+lease_status_licencas = MongoLease("status_licencas", ALERTAS_LEASE_SECONDS)
+
+async def existe_alerta_devido(agora: datetime) -> bool:
+    licenca, cond = await asyncio.gather(
+        db.licencas_documentos.find_one({"next_alert_at": {"$lte": agora}}, {"_id": 1}),
+        db.condicionantes.find_one({"next_alert_at": {"$lte": agora}}, {"_id": 1})
+    )
+    return bool(licenca or cond)
 
 async def scheduler_alertas():
-    """Scheduler que roda a cada hora verificando alertas"""
+    """Dorme até o próximo prazo da agenda e então verifica, sob o lease"""
+    try:
+        await preencher_next_alert_at()
+        await agenda_alertas.sincronizar(datetime.now(timezone.utc))
+    except Exception as e:
+        logger.error(f"Erro ao carregar agenda de alertas: {e}")
+    
     while True:
         try:
-            await verificar_licencas_vencendo()
+            agora = datetime.now(timezone.utc)
+            proximo = agenda_alertas.proximo()
+            espera = ALERTAS_RESINCRONIZACAO_SECONDS
+            if proximo is not None:
+                espera = min(espera, (proximo - agora).total_seconds())
+            
+            if espera > 0:
+                if await agenda_alertas.aguardar(espera):
+                    continue  # uma escrita mudou a agenda
+                if proximo is None or proximo > datetime.now(timezone.utc):
+                    await agenda_alertas.sincronizar(datetime.now(timezone.utc))
+                    continue
+            
+            # Prazo atingido: outro worker pode já ter feito a varredura
+            agora = datetime.now(timezone.utc)
+            if await existe_alerta_devido(agora):
+                executou, _ = await lease_alertas.executar(verificar_licencas_vencendo)
+                if not executou:
+                    await asyncio.sleep(ALERTAS_LEASE_SECONDS / 2)
+            await agenda_alertas.sincronizar(datetime.now(timezone.utc))
+            
+            # A varredura não adiou o prazo vencido (nada reagendado): evita laço quente
+            proximo = agenda_alertas.proximo()
+            if proximo is not None and proximo <= datetime.now(timezone.utc):
+                logger.warning(f"Prazo de alerta {proximo.isoformat()} continua vencido após a varredura")
+                await asyncio.sleep(ALERTAS_BACKOFF_SECONDS)
         except Exception as e:
             logger.error(f"Erro no scheduler de alertas: {e}")
-        
-        # Aguardar 1 hora antes da próxima verificação
-        await asyncio.sleep(3600)
+            await asyncio.sleep(max(ALERTAS_BACKOFF_SECONDS, ALERTAS_LEASE_SECONDS))
 
 # Endpoint manual para disparar verificação
 @api_router.post("/alertas/verificar")
@@ -2049,9 +3883,32 @@ async def verificar_alertas_manual(request: Request):
     if not is_gestor(user):
         raise HTTPException(status_code=403, detail="Apenas gestores podem disparar verificação")
     
-    alertas_enviados = await verificar_licencas_vencendo()
+    try:
+        executou, alertas_enviados = await lease_alertas.executar(verificar_licencas_vencendo)
+    except Exception as e:
+        logger.error(f"Erro na verificação manual de alertas: {e}")
+        raise HTTPException(status_code=500, detail="Falha na verificação de alertas")
+    if not executou:
+        raise HTTPException(status_code=409, detail="Verificação de alertas já em andamento")
     return {"message": f"Verificação concluída. {alertas_enviados} alertas enviados."}
 
+@api_router.post("/admin/licencas/status")
+async def atualizar_status_licencas_manual(request: Request):
+    """Dispara a atualização do status materializado das licenças (apenas gestor)"""
+    user = await get_current_user(request)
+    
+    if not is_gestor(user):
+        raise HTTPException(status_code=403, detail="Apenas administradores")
+    
+    try:
+        executou, atualizadas = await lease_status_licencas.executar(atualizar_status_licencas)
+    except Exception as e:
+        logger.error(f"Erro na atualização manual do status das licenças: {e}")
+        raise HTTPException(status_code=500, detail="Falha na atualização do status das licenças")
+    if not executou:
+        raise HTTPException(status_code=409, detail="Atualização de status já em andamento")
+    return {"message": f"Status atualizado em {atualizadas} licenças.", "atualizadas": atualizadas}
+
 # Endpoint para listar alertas enviados
 @api_router.get("/alertas/historico")
 async def get_historico_alertas(request: Request, dias: int = 30):
@@ -2074,29 +3931,90 @@ async def update_alerta_config(licenca_id: str, dias_alerta: int, request: Reque
     """Atualiza dias de antecedência para alerta de vencimento"""
     user = await get_current_user(request)
     
-    if dias_alerta < 1 or dias_alerta > 180:
-        raise HTTPException(status_code=400, detail="Dias de alerta deve ser entre 1 e 180")
+    if dias_alerta < 1 or dias_alerta > ALERTA_HORIZONTE_MAXIMO_DIAS:
+        raise HTTPException(status_code=400, detail=f"Dias de alerta deve ser entre 1 e {ALERTA_HORIZONTE_MAXIMO_DIAS}")
     
-    await db.licencas_documentos.update_one(
+    licenca = await db.licencas_documentos.find_one_and_update(
         {"licenca_id": licenca_id},
-        {"$set": {"dias_alerta_vencimento": dias_alerta}}
+        {"$set": {"dias_alerta_vencimento": dias_alerta}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
+    if licenca:
+        await recalcular_licenca(licenca)
     
     return {"message": f"Alerta configurado para {dias_alerta} dias antes do vencimento"}
 
 @api_router.get("/admin/users")
-async def get_all_users(request: Request):
+async def get_all_users(
+    request: Request,
+    response: Response,
+    busca: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 1000
+):
+    """Diretório de usuários com empresas, último login e total de tickets.
+
+    A página vem de uma agregação com $lookup; o total (após a busca) é um
+    count_documents à parte e vai no header X-Total-Count.
+    """
     user = await get_current_user(request)
     if not is_gestor(user):
         raise HTTPException(status_code=403, detail="Apenas administradores")
-    users = await db.users.find({}, {"_id": 0}).to_list(1000)
-    for u in users:
-        empresas = await db.empresas.find({"user_id": u["user_id"]}, {"_id": 0}).to_list(100)
-        u["empresas"] = empresas
-        last_session = await db.user_sessions.find_one({"user_id": u["user_id"]}, {"_id": 0}, sort=[("created_at", -1)])
-        u["last_login"] = last_session["created_at"] if last_session else None
-        u["tickets_count"] = await db.tickets.count_documents({"user_id": u["user_id"]})
-    return users
+    
+    filtro = {}
+    if busca:
+        padrao = {"$regex": re.escape(busca), "$options": "i"}
+        filtro = {"$or": [{"name": padrao}, {"email": padrao}]}
+    
+    # Total e página em consultas separadas: $match + $sort no início do
+    # pipeline usam o índice (created_at, user_id), e só a página passa pelos $lookup
+    pagina = db.users.aggregate([
+        {"$match": filtro},
+        {"$sort": {"created_at": -1, "user_id": 1}},
+        {"$skip": max(skip, 0)},
+        {"$limit": max(1, min(limit, 1000))},
+        {"$lookup": {
+            "from": "empresas",
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "pipeline": [{"$project": {"_id": 0}}],
+            "as": "empresas"
+        }},
+        {"$lookup": {
+            "from": "tickets",
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "pipeline": [{"$count": "n"}],
+            "as": "tickets"
+        }},
+        # Sessões só são consultadas para quem ainda não tem last_login_at
+        {"$lookup": {
+            "from": "user_sessions",
+            "let": {"uid": "$user_id", "last_login_at": "$last_login_at"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": [{"$ifNull": ["$$last_login_at", None]}, None]},
+                    {"$eq": ["$user_id", "$$uid"]}
+                ]}}},
+                {"$sort": {"created_at": -1}},
+                {"$limit": 1},
+                {"$project": {"_id": 0, "created_at": 1}}
+            ],
+            "as": "ultima_sessao"
+        }},
+        {"$set": {
+            "last_login": {"$ifNull": [
+                "$last_login_at",
+                {"$first": "$ultima_sessao.created_at"}
+            ]},
+            "tickets_count": {"$ifNull": [{"$first": "$tickets.n"}, 0]}
+        }},
+        {"$project": {"_id": 0, "tickets": 0, "ultima_sessao": 0, "last_login_at": 0}}
+    ]).to_list(None)
+    total, usuarios = await asyncio.gather(db.users.count_documents(filtro), pagina)
+    response.headers["X-Total-Count"] = str(total)
+    return usuarios
 
 @api_router.delete("/admin/users/{user_id}")
 async def delete_user_admin(user_id: str, request: Request):
@@ -2108,12 +4026,94 @@ async def delete_user_admin(user_id: str, request: Request):
     await db.empresas.delete_many({"user_id": user_id})
     await db.tickets.delete_many({"user_id": user_id})
     await db.user_sessions.delete_many({"user_id": user_id})
+    session_cache.invalidate_user(user_id)
+    await revocation_set.revoke_user(user_id)
     await db.clientes.delete_many({"user_id": user_id})
     result = await db.users.delete_one({"user_id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
     return {"message": "Usuário excluído com sucesso"}
 
+@api_router.get("/admin/metricas")
+async def get_metricas_admin(request: Request):
+    """Métricas internas do processo (cache de sessões etc.)"""
+    user = await get_current_user(request)
+    if not is_gestor(user):
+        raise HTTPException(status_code=403, detail="Apenas administradores")
+    return {
+        "session_cache": session_cache.stats(),
+        "sessoes_assinadas": revocation_set.stats(),
+        "notificacoes": notificacoes.stats()
+    }
+
+async def backfill_derivados():
+    """Gera derivados faltantes para todas as fotos já existentes"""
+    semaforo = asyncio.Semaphore(DERIVADOS_WORKERS)
+    
+    async def processar(original_id: str):
+        async with semaforo:
+            await gerar_derivados(original_id)
+    
+    fotos = set(await db.areas_criticas.distinct("foto_cliente_id", {"foto_cliente_id": {"$ne": None}}))
+    fotos |= set(await db.inspecao_itens.distinct("foto_id", {"foto_id": {"$ne": None}}))
+    logger.info(f"🖼️  Backfill de derivados iniciado ({len(fotos)} fotos)")
+    await asyncio.gather(*(processar(f) for f in fotos))
+    logger.info("🖼️  Backfill de derivados concluído")
+
+@api_router.post("/admin/derivados/backfill")
+async def iniciar_backfill_derivados(request: Request):
+    """Dispara em background a geração de miniaturas das fotos existentes"""
+    user = await get_current_user(request)
+    if not is_gestor(user):
+        raise HTTPException(status_code=403, detail="Apenas administradores")
+    em_background(backfill_derivados())
+    return {"message": "Geração de derivados iniciada"}
+
+@api_router.get("/admin/indices")
+async def get_auditoria_indices(request: Request):
+    """Uso dos índices por coleção e consultas conhecidas que ainda fazem COLLSCAN"""
+    user = await get_current_user(request)
+    if not is_gestor(user):
+        raise HTTPException(status_code=403, detail="Apenas administradores")
+    
+    colecoes = {}
+    for colecao, indices in CATALOGO_INDICES.items():
+        existentes = await db[colecao].index_information()
+        chaves_existentes = [[tuple(k) for k in info["key"]] for info in existentes.values()]
+        uso = await db[colecao].aggregate([{"$indexStats": {}}]).to_list(None)
+        colecoes[colecao] = {
+            "indices": [
+                {
+                    "nome": u["name"],
+                    "chaves": u["key"],
+                    "acessos": u["accesses"]["ops"],
+                    "desde": u["accesses"]["since"]
+                }
+                for u in uso
+            ],
+            "faltando": [
+                spec["keys"] for spec in indices
+                if spec["keys"] not in chaves_existentes
+            ]
+        }
+    
+    consultas_com_scan = []
+    for colecao, filtro, ordenacao in CONSULTAS_AUDITADAS:
+        cursor = db[colecao].find(filtro)
+        if ordenacao:
+            cursor = cursor.sort(ordenacao)
+        plano = (await cursor.explain())["queryPlanner"]["winningPlan"]
+        estagios = _estagios_plano(plano)
+        if "COLLSCAN" in estagios or "SORT" in estagios:
+            consultas_com_scan.append({
+                "colecao": colecao,
+                "filtro": filtro,
+                "ordenacao": ordenacao,
+                "estagios": estagios
+            })
+    
+    return {"colecoes": colecoes, "consultas_com_scan": consultas_com_scan}
+
 app.include_router(api_router)
 
 app.add_middleware(
@@ -2122,16 +4122,31 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],
 )
 
 @app.on_event("startup")
 async def startup_event():
     """Inicia o scheduler de alertas ao iniciar a aplicação"""
+    global oauth_client
     logger.info("🚀 EcoGuard iniciado!")
+    oauth_client = criar_oauth_client()
+    notificacoes.iniciar()
+    em_background(aplicar_catalogo_indices())
+    em_background(limpar_sessoes_expiradas())
+    em_background(limpar_relatorios_descartados())
+    em_background(job_status_licencas())
     # Iniciar scheduler de alertas em background
-    asyncio.create_task(scheduler_alertas())
-    logger.info("📅 Scheduler de alertas automáticos iniciado (verifica a cada hora)")
+    em_background(scheduler_alertas())
+    logger.info("📅 Scheduler de alertas automáticos iniciado (por prazo)")
+    if SESSION_SECRET:
+        em_background(atualizar_revogacoes())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await notificacoes.drenar(NOTIFICACOES_DRENO_TIMEOUT)
+    if oauth_client is not None:
+        await oauth_client.aclose()
+    if _pool_imagens is not None:
+        _pool_imagens.shutdown(wait=False, cancel_futures=True)
+    client.close()
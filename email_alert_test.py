@@ -102,16 +102,16 @@ class EmailAlertTester:
                 return False
             
             # Check for email notification function
-            if 'async def enviar_email_notificacao(' in content:
+            if 'def enviar_email_notificacao(' in content:
                 self.log_test("Email Function", True, "Email notification function is implemented")
             else:
                 self.log_test("Email Function", False, "Email notification function not found")
                 return False
             
             # Check for email calls in ticket operations
-            email_calls_found = 0
-            if 'await enviar_email_notificacao(' in content:
-                email_calls_found = content.count('await enviar_email_notificacao(')
+            # Calls are queued (no await); the definition itself is not a call
+            email_calls_found = content.count('enviar_email_notificacao(') - content.count('def enviar_email_notificacao(')
+            if email_calls_found > 0:
                 self.log_test("Email Integration", True, f"Found {email_calls_found} email notification calls")
             else:
                 self.log_test("Email Integration", False, "No email notification calls found")
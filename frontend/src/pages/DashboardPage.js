@@ -283,7 +283,7 @@ const DashboardPage = ({ user }) => {
               <div className="space-y-3">
                 {licencas.map((licenca, index) => {
                   const isVencida = licenca.status === 'vencida';
-                  const isVencendo = licenca.status === 'vencendo_30dias';
+                  const isVencendo = licenca.status === 'a_vencer';
                   
                   return (
                     <div
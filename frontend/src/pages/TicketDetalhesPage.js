@@ -321,7 +321,7 @@ const TicketDetalhesPage = ({ user }) => {
                           <p className="text-sm text-muted-foreground">Foto enviada pelo cliente:</p>
                           <div className="relative">
                             <img 
-                              src={`${API}/areas/${area.area_id}/foto-cliente`}
+                              src={`${API}/areas/${area.area_id}/foto-cliente?v=${area.foto_cliente_id}`}
                               alt={`Foto de ${area.nome}`}
                               className="max-h-64 w-full object-contain rounded-md border bg-gray-50 cursor-pointer"
                               onClick={() => viewFotoCliente(area.area_id)}